@@ -0,0 +1,307 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic benchmark of the Pydnet forward pass.
+Every combination of backend, resolution, batch size and number of threads
+is run over random inputs, so that no dataset is needed. Results are
+printed (or saved) as JSON.
+
+Usage:
+    python benchmark.py --resolutions 192x384,320x640 --batch_sizes 1,4 \
+        --intra_threads 1,4 --output benchmark.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+
+from predictor import (
+    ONNX_OPTIMIZATIONS,
+    STRIDE,
+    ONNXPredictor,
+    Predictor,
+    TFLitePredictor,
+    session_config,
+)
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+
+def parse_list(values, cast=int):
+    """ Parse a comma separated list """
+    return [cast(v) for v in values.split(",") if v]
+
+
+def parse_resolution(value):
+    """ Parse a resolution as HEIGHTxWIDTH """
+    height, width = value.lower().split("x")
+    return int(height), int(width)
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process, in MB """
+    # NOTE: ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def create_benchmark_predictor(config):
+    """ Create the predictor of a benchmark configuration """
+    if config["backend"] == "tflite":
+        num_threads = config["intra_threads"] or None
+        return TFLitePredictor(config["tflite"], num_threads=num_threads)
+    if config["backend"] == "onnx":
+        return ONNXPredictor(
+            config["onnx"],
+            num_threads=config["intra_threads"] or None,
+            inter_op_threads=config["inter_threads"] or None,
+            optimization=config["onnx_optimization"],
+        )
+
+    session = session_config(config["intra_threads"], config["inter_threads"])
+    network_options = {
+        "exit_level": config["exit_level"],
+        "fused_upsampling": config["fused_upsampling"],
+        "precision": config["precision"],
+    }
+    return Predictor(
+        config["ckpt"],
+        config["height"],
+        config["width"],
+        config=session,
+        network_options=network_options,
+    )
+
+
+def run_config(config):
+    """ Benchmark a single configuration
+    Args:
+        config: dictionary with backend, ckpt, tflite, onnx, height, width,
+            batch_size, intra_threads, inter_threads, warmup and iterations
+    Returns:
+        dictionary with the configuration and its measures, times in seconds
+    """
+    start = time.perf_counter()
+    predictor = create_benchmark_predictor(config)
+    load_time = time.perf_counter() - start
+
+    shape = (config["batch_size"], predictor.height, predictor.width, 3)
+    batch_img = np.random.uniform(size=shape).astype(np.float32)
+
+    start = time.perf_counter()
+    predictor.predict(batch_img)
+    first_run = time.perf_counter() - start
+    for _ in range(config["warmup"]):
+        predictor.predict(batch_img)
+    warmup_time = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(config["iterations"]):
+        start = time.perf_counter()
+        predictor.predict(batch_img)
+        latencies.append(time.perf_counter() - start)
+    predictor.close()
+
+    latencies = np.array(latencies)
+    result = dict(config)
+    result.update(
+        {
+            "height": predictor.height,
+            "width": predictor.width,
+            "load_time": load_time,
+            "first_run": first_run,
+            "warmup_time": warmup_time,
+            "latency_mean": float(latencies.mean()),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+            "throughput": shape[0] * len(latencies) / float(latencies.sum()),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    )
+    return result
+
+
+def run_isolated(config):
+    """ Benchmark a configuration in a fresh process, so that warm-up and
+    peak memory are not affected by the previous configurations """
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_config, (config,))
+
+
+def build_configs(opts):
+    """ All the combinations of the benchmark parameters """
+    configs = []
+    combinations = itertools.product(
+        parse_list(opts.backends, str),
+        parse_list(opts.resolutions, parse_resolution),
+        parse_list(opts.batch_sizes),
+        parse_list(opts.intra_threads),
+        parse_list(opts.inter_threads),
+        parse_list(opts.exit_levels),
+        parse_list(opts.precisions, str),
+    )
+    for config_values in combinations:
+        backend, (height, width), batch_size, intra, inter = config_values[:5]
+        exit_level, precision = config_values[5:]
+        if backend not in ["tf", "tflite", "onnx"]:
+            raise ValueError("Unknown backend {}".format(backend))
+        if backend == "tflite" and opts.tflite is None:
+            raise ValueError("tflite backend requires a tflite model")
+        if backend == "onnx" and opts.onnx is None:
+            raise ValueError("onnx backend requires an onnx model")
+        if height % STRIDE != 0 or width % STRIDE != 0:
+            raise ValueError("resolutions must be multiple of {}".format(STRIDE))
+        if exit_level not in range(1, 7):
+            raise ValueError("exit levels must be in [1, 6]")
+        if precision not in ["float32", "float16"]:
+            raise ValueError("precisions must be float32 or float16")
+        config = {
+            "backend": backend,
+            "ckpt": opts.ckpt,
+            "tflite": opts.tflite,
+            "onnx": opts.onnx,
+            "onnx_optimization": opts.onnx_optimization,
+            "height": height,
+            "width": width,
+            "batch_size": batch_size,
+            "intra_threads": intra,
+            "inter_threads": inter,
+            "exit_level": exit_level,
+            "fused_upsampling": opts.fused_upsampling,
+            "precision": precision,
+            "warmup": opts.warmup,
+            "iterations": opts.iterations,
+        }
+        if backend in ["tflite", "onnx"]:
+            # NOTE: tflite and onnx models have the resolution and the exit
+            # level chosen at export time
+            config.update(
+                {
+                    "height": None,
+                    "width": None,
+                    "exit_level": None,
+                    "fused_upsampling": None,
+                    "precision": None,
+                }
+            )
+        if backend == "tflite":
+            # NOTE: inter-op threads are not used by tflite
+            config["inter_threads"] = 0
+        if backend != "onnx":
+            config["onnx_optimization"] = None
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Pydnet forward pass")
+    parser.add_argument(
+        "--ckpt", type=str, help="path to checkpoint. If not set, random weights are used"
+    )
+    parser.add_argument("--tflite", type=str, help="path to tflite model")
+    parser.add_argument("--onnx", type=str, help="path to onnx model")
+    parser.add_argument(
+        "--onnx_optimization",
+        type=str,
+        choices=list(ONNX_OPTIMIZATIONS),
+        help="graph optimization level of onnxruntime",
+        default="all",
+    )
+    parser.add_argument(
+        "--backends",
+        type=str,
+        help="comma separated list of tf, tflite, onnx",
+        default="tf",
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=str,
+        help="comma separated list of HEIGHTxWIDTH, multiple of 64",
+        default="320x640",
+    )
+    parser.add_argument(
+        "--batch_sizes", type=str, help="comma separated list of batch sizes", default="1"
+    )
+    parser.add_argument(
+        "--intra_threads",
+        type=str,
+        help="comma separated list of intra-op threads, 0 is the default of the backend",
+        default="0",
+    )
+    parser.add_argument(
+        "--inter_threads",
+        type=str,
+        help="comma separated list of inter-op threads, 0 is the default of the backend",
+        default="0",
+    )
+    parser.add_argument(
+        "--exit_levels",
+        type=str,
+        help="comma separated list of decoder exit levels, for tf backend",
+        default="1",
+    )
+    parser.add_argument(
+        "--precisions",
+        type=str,
+        help="comma separated list of float32, float16, for tf backend",
+        default="float32",
+    )
+    parser.add_argument(
+        "--fused_upsampling",
+        action="store_true",
+        help="fold bilinear upsampling and convolution of the decoder, for tf backend",
+    )
+    parser.add_argument("--warmup", type=int, help="runs before measuring", default=5)
+    parser.add_argument("--iterations", type=int, help="measured runs", default=50)
+    parser.add_argument(
+        "--in_process",
+        action="store_true",
+        help="run all configurations in this process. Peak memory is cumulative",
+    )
+    parser.add_argument("--output", type=str, help="path of the json report")
+    opts = parser.parse_args()
+
+    if opts.iterations < 1:
+        raise ValueError("iterations must be greater than 0")
+
+    results = []
+    for config in build_configs(opts):
+        result = run_config(config) if opts.in_process else run_isolated(config)
+        print(
+            "=> {backend} {height}x{width} batch {batch_size} threads "
+            "{intra_threads}/{inter_threads} exit {exit_level} {precision}: "
+            "p50 {latency_p50:.4f}s {throughput:.1f} img/s".format(**result)
+        )
+        results.append(result)
+
+    report = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(report)
+        print("=> saved {}".format(opts.output))
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
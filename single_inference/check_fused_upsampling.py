@@ -0,0 +1,103 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Check that fused_bilinear_upsampling_by_convolution matches
+bilinear_upsampling_by_convolution, without checkpoint or images.
+Both upsamplers are built in the same graph over the same random variables,
+and run on random features of several sizes, odd ones included.
+
+Usage:
+    python check_fused_upsampling.py
+    python check_fused_upsampling.py --sizes 5x10,7x3 --channels 8
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+from modules import (
+    bilinear_upsampling_by_convolution,
+    fused_bilinear_upsampling_by_convolution,
+)
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+
+def parse_size(value):
+    """ Parse a size as HEIGHTxWIDTH """
+    height, width = value.lower().split("x")
+    return int(height), int(width)
+
+
+def max_difference(height, width, channels, batch_size, seed):
+    """ Max absolute difference between the original and the fused
+    upsampling of random features, with the same random variables """
+    with tf.Graph().as_default():
+        tf.set_random_seed(seed)
+        features = tf.placeholder(tf.float32, [batch_size, height, width, channels])
+        with tf.variable_scope("upsampler"):
+            expected = bilinear_upsampling_by_convolution(features)
+        with tf.variable_scope("upsampler", reuse=True):
+            fused = fused_bilinear_upsampling_by_convolution(features)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            rng = np.random.RandomState(seed)
+            value = rng.uniform(-1.0, 1.0, size=features.shape.as_list())
+            expected_value, fused_value = sess.run(
+                [expected, fused], feed_dict={features: value.astype(np.float32)}
+            )
+    if expected_value.shape != fused_value.shape:
+        raise ValueError(
+            "shapes differ: {} and {}".format(expected_value.shape, fused_value.shape)
+        )
+    return np.abs(expected_value - fused_value).max()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the fused upsampling")
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        help="comma separated sizes of the features, as HEIGHTxWIDTH",
+        default="5x10,4x8,7x3,1x1,10x20",
+    )
+    parser.add_argument("--channels", type=int, help="channels of the features", default=8)
+    parser.add_argument("--batch_size", type=int, help="samples of a batch", default=2)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="maximum absolute difference allowed",
+        default=1e-5,
+    )
+    opts = parser.parse_args()
+
+    failed = False
+    for size in opts.sizes.split(","):
+        height, width = parse_size(size)
+        difference = max_difference(height, width, opts.channels, opts.batch_size, opts.seed)
+        print("{}x{}: max difference {:.2e}".format(height, width, difference))
+        failed = failed or difference > opts.tolerance
+    if failed:
+        print("=> FAILED, tolerance is {}".format(opts.tolerance))
+        sys.exit(1)
+    print("=> OK")
+
+
+if __name__ == "__main__":
+    main()
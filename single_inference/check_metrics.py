@@ -0,0 +1,105 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Check the batched metrics of eval_utils against the per-sample ones, on
+random samples shaped as KITTI ground truth, and report their speedup.
+Means of the batched metrics must be identical to the per-sample ones, bit
+for bit, also with a pool of workers.
+
+Usage:
+    python check_metrics.py --samples 100
+    python check_metrics.py --samples 100 --workers 4
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from eval_utils import ErrorsReducer, align_and_compute_errors
+
+KITTI_SHAPES = [(375, 1242), (370, 1224), (374, 1238), (376, 1241)]
+
+
+def random_samples(num_samples, density, seed):
+    """ Random predictions in [0, 255] and sparse ground truth depths """
+    rng = np.random.RandomState(seed)
+    predictions = []
+    targets = []
+    for index in range(num_samples):
+        # NOTE: consecutive samples share their size, as in KITTI sequences
+        shape = KITTI_SHAPES[(index // 8) % len(KITTI_SHAPES)]
+        target = rng.uniform(0.5, 90.0, size=shape).astype(np.float32)
+        target[rng.uniform(size=shape) > density] = 0
+        prediction = 255.0 * rng.uniform(size=shape).astype(np.float32)
+        predictions.append(prediction.astype(np.float64))
+        targets.append(target)
+    return predictions, targets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check batched metrics")
+    parser.add_argument("--samples", type=int, help="number of samples", default=64)
+    parser.add_argument("--batch_size", type=int, help="samples of a batch", default=16)
+    parser.add_argument(
+        "--density", type=float, help="fraction of valid ground truth", default=0.05
+    )
+    parser.add_argument("--max_depth", type=float, help="maximum depth value", default=80.0)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    parser.add_argument(
+        "--workers", type=int, help="processes computing the errors", default=0
+    )
+    opts = parser.parse_args()
+
+    predictions, targets = random_samples(opts.samples, opts.density, opts.seed)
+
+    start = time.perf_counter()
+    errors = [
+        align_and_compute_errors(prediction, target, 1e-3, opts.max_depth)
+        for prediction, target in zip(predictions, targets)
+    ]
+    expected = np.array(errors).mean(0)
+    per_sample_time = time.perf_counter() - start
+
+    def run_batched(workers):
+        start = time.perf_counter()
+        errors_reducer = ErrorsReducer(1e-3, opts.max_depth, workers)
+        for i in range(0, opts.samples, opts.batch_size):
+            batch = slice(i, i + opts.batch_size)
+            errors_reducer.submit(predictions[batch], targets[batch])
+        return errors_reducer.mean(), time.perf_counter() - start
+
+    computed, batched_time = run_batched(0)
+    print(
+        "=> per sample: {:.3f}s, batched: {:.3f}s, speedup {:.2f}x".format(
+            per_sample_time, batched_time, per_sample_time / batched_time
+        )
+    )
+    if not np.array_equal(expected, computed):
+        difference = np.max(np.abs(expected - computed) / np.abs(expected))
+        print("=> FAILED, batched means differ, relative difference {:.3e}".format(difference))
+        sys.exit(1)
+
+    if opts.workers > 0:
+        computed_by_workers, workers_time = run_batched(opts.workers)
+        print("=> {} workers: {:.3f}s".format(opts.workers, workers_time))
+        if not np.array_equal(computed, computed_by_workers):
+            print("=> FAILED, workers change the means")
+            sys.exit(1)
+    print("=> OK")
+
+
+if __name__ == "__main__":
+    main()
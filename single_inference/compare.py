@@ -0,0 +1,146 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cross-check a backend against the checkpoint.
+The same images are run by the tf graph restored from the checkpoint and by
+the selected backend, and the depths, normalized in [0, 1], are compared.
+
+Usage:
+    python compare.py --ckpt ckpt/pydnet --backend tflite \
+        --tflite frozen_models/tflite_pydnet.tflite --img test
+    python compare.py --ckpt ckpt/pydnet --backend onnx \
+        --onnx frozen_models/pydnet.onnx --img test
+    python compare.py --ckpt ckpt/pydnet --backend tf --fused_upsampling --img test
+    python compare.py --ckpt ckpt/pydnet --backend tf --precision float16 \
+        --tolerance 1e-2 --img test
+"""
+import argparse
+import glob
+import os
+import sys
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from colormap import normalize
+from predictor import (
+    BACKENDS,
+    Predictor,
+    create_predictor,
+    load_network_config,
+    prepare_frame,
+)
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+
+def compare(reference, candidate, img_list):
+    """ Run two predictors over the same images
+    Args:
+        reference: reference predictor
+        candidate: predictor to check
+        img_list: list of image paths
+    Returns:
+        max and mean absolute difference between normalized depths, per image
+    """
+    max_diffs = []
+    mean_diffs = []
+    for path in img_list:
+        img, _ = prepare_frame(cv2.imread(path), candidate.height, candidate.width)
+        batch_img = np.expand_dims(img, 0)
+        expected = normalize(reference.predict(batch_img)[0])
+        predicted = normalize(candidate.predict(batch_img)[0])
+        diff = np.abs(expected - predicted)
+        max_diffs.append(diff.max())
+        mean_diffs.append(diff.mean())
+        print("{}: max {:.6f} mean {:.6f}".format(path, max_diffs[-1], mean_diffs[-1]))
+    return np.array(max_diffs), np.array(mean_diffs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a backend with the checkpoint")
+    parser.add_argument("--ckpt", type=str, help="path to checkpoint", required=True)
+    parser.add_argument("--img", type=str, help="image or folder of images", required=True)
+    parser.add_argument(
+        "--backend", type=str, choices=BACKENDS, help="backend to check", default="tflite"
+    )
+    parser.add_argument("--tflite", type=str, help="path to tflite model")
+    parser.add_argument("--onnx", type=str, help="path to onnx model")
+    parser.add_argument("--frozen", type=str, help="path to frozen graph")
+    parser.add_argument(
+        "--fused_upsampling",
+        action="store_true",
+        help="check the decoder with fused upsampling, for tf backend",
+    )
+    parser.add_argument(
+        "--network_config",
+        type=str,
+        help="json with additional network params, e.g. channels of a pruned checkpoint",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=["float32", "float16"],
+        help="compute precision to check, for tf backend",
+        default="float32",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="maximum absolute difference allowed on normalized depth",
+        default=1e-3,
+    )
+    opts = parser.parse_args()
+
+    if os.path.isdir(opts.img):
+        img_list = sorted(glob.glob(os.path.join(opts.img, "*.png")))
+    else:
+        img_list = [opts.img]
+
+    # NOTE: reference and candidate share the channels of the checkpoint
+    network_config = load_network_config(opts.network_config)
+    network_options = dict(network_config)
+    network_options.update(
+        {"fused_upsampling": opts.fused_upsampling, "precision": opts.precision}
+    )
+    candidate = create_predictor(
+        opts.backend,
+        opts.ckpt,
+        opts.tflite,
+        frozen=opts.frozen,
+        network_options=network_options,
+        onnx=opts.onnx,
+    )
+    reference = Predictor(
+        opts.ckpt,
+        candidate.height,
+        candidate.width,
+        network_options=network_config,
+    )
+    max_diffs, mean_diffs = compare(reference, candidate, img_list)
+
+    print("=> max difference: {:.6f}".format(max_diffs.max()))
+    print("=> mean difference: {:.6f}".format(mean_diffs.mean()))
+    if max_diffs.max() > opts.tolerance:
+        print("=> FAILED, tolerance is {}".format(opts.tolerance))
+        sys.exit(1)
+    print("=> OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+import collections
+import multiprocessing
+
 import numpy as np
 
 
@@ -44,3 +47,280 @@ def compute_scale_and_shift(prediction, target, mask):
     x_1[valid] = (-a_01[valid] * b_0[valid] + a_00[valid] * b_1[valid]) / det[valid]
 
     return x_0, x_1
+
+
+def align_and_compute_errors(prediction_idepth, target, min_depth, max_depth):
+    """Align the predicted inverse depth to the ground truth in scale and
+    shift, and compute error metrics on valid pixels"""
+    mask = (target > min_depth) & (target < max_depth)
+
+    target_idepth = np.zeros_like(target)
+    target_idepth[mask == 1] = 1.0 / target[mask == 1]
+    scale, shift = compute_scale_and_shift(prediction_idepth, target_idepth, mask)
+    prediction_idepth_aligned = scale * prediction_idepth + shift
+
+    disparity_cap = 1.0 / max_depth
+    prediction_idepth_aligned[prediction_idepth_aligned < disparity_cap] = disparity_cap
+    prediciton_depth_aligned = 1.0 / prediction_idepth_aligned
+
+    prediciton_depth_aligned = prediciton_depth_aligned[mask == 1]
+    target = target[mask == 1]
+    return compute_errors(target, prediciton_depth_aligned)
+
+
+def sample_starts(counts):
+    """Start of each sample in the layout of sum_samples"""
+    return np.cumsum(counts + 1) - counts - 1
+
+
+def sum_samples(values, counts):
+    """Sum of the values of each sample in a single reduction, bit-for-bit
+    as np.sum of each sample
+    Args:
+        values: values of N samples, concatenated, each one after a zero
+        counts: number of values of each sample, without its zero
+    """
+    # NOTE: np.add.reduceat starts from the first value of each sample,
+    # while np.sum starts from zero, hence the zero before each sample
+    return np.add.reduceat(values, sample_starts(counts))
+
+
+def compute_scale_and_shift_batch(prediction, target, sizes, counts):
+    """Batched compute_scale_and_shift, solving the alignment of N samples at once
+    Args:
+        prediction: predictions of N samples, zero on invalid pixels,
+            concatenated as in sum_samples
+        target: targets of the same pixels, zero on invalid pixels
+        sizes: number of pixels of each sample
+        counts: number of valid pixels of each sample
+    Returns:
+        N scales and N shifts
+    """
+    # NOTE: a single buffer for the products, as large as the samples
+    product = np.empty_like(prediction)
+
+    # system matrix: A = [[a_00, a_01], [a_10, a_11]]
+    a_00 = sum_samples(np.multiply(prediction, prediction, out=product), sizes)
+    a_01 = sum_samples(prediction, sizes)
+    a_11 = counts
+
+    # right hand side: b = [b_0, b_1]
+    b_0 = sum_samples(np.multiply(prediction, target, out=product), sizes)
+    b_1 = sum_samples(target, sizes)
+    x_0 = np.zeros_like(b_0)
+    x_1 = np.zeros_like(b_1)
+
+    det = a_00 * a_11 - a_01 * a_01
+    valid = det > 0
+
+    x_0[valid] = (a_11[valid] * b_0[valid] - a_01[valid] * b_1[valid]) / det[valid]
+    x_1[valid] = (-a_01[valid] * b_0[valid] + a_00[valid] * b_1[valid]) / det[valid]
+
+    return x_0, x_1
+
+
+def compute_errors_batch(gt, pred, counts):
+    """Batched compute_errors, with a single pass over the pixels of N samples
+    Args:
+        gt: valid ground truth depths of N samples, concatenated as in
+            sum_samples, each sample after a depth of 1
+        pred: predicted depths of the same pixels, 1 before each sample, so
+            that errors are zero there
+        counts: number of valid pixels of each sample
+    Returns:
+        Nx7 errors, as compute_errors for each sample
+    """
+    thresh = np.maximum((gt / pred), (pred / gt))
+    difference = gt - pred
+    squared = difference * difference
+    squared_log = np.log(gt) - np.log(pred)
+    squared_log *= squared_log
+    abs_rel = np.abs(difference, out=difference)
+    abs_rel /= gt
+    sq_rel = squared / gt
+
+    errors = np.empty((len(counts), 7))
+    errors[:, 0] = sum_samples(abs_rel, counts) / counts
+    errors[:, 1] = sum_samples(sq_rel, counts) / counts
+    errors[:, 2] = np.sqrt(sum_samples(squared, counts) / counts)
+    errors[:, 3] = np.sqrt(sum_samples(squared_log, counts) / counts)
+    starts = sample_starts(counts)
+    for column, threshold in enumerate([1.25, 1.25 ** 2, 1.25 ** 3], 4):
+        # NOTE: thresh is 1 before each sample, so it is below any threshold
+        below = np.add.reduceat(thresh < threshold, starts, dtype=np.int64) - 1
+        errors[:, column] = below / counts
+    return errors
+
+
+def align_and_compute_errors_batch(
+    prediction_idepth,
+    target_idepth,
+    valid_prediction_idepth,
+    valid_target,
+    sizes,
+    counts,
+    max_depth,
+):
+    """Batched align_and_compute_errors
+    Args:
+        prediction_idepth: predicted inverse depths of N samples, zero on
+            invalid pixels, concatenated as in sum_samples
+        target_idepth: ground truth inverse depths, zero on invalid pixels
+        valid_prediction_idepth: predicted inverse depths of the valid pixels
+            only, concatenated as in sum_samples
+        valid_target: ground truth depths of the same pixels, concatenated
+            as in compute_errors_batch
+        sizes: number of pixels of each sample
+        counts: number of valid pixels of each sample
+    Returns:
+        Nx7 errors
+    """
+    scale, shift = compute_scale_and_shift_batch(
+        prediction_idepth, target_idepth, sizes, counts
+    )
+    prediction_idepth_aligned = np.repeat(scale, counts + 1) * valid_prediction_idepth
+    prediction_idepth_aligned += np.repeat(shift, counts + 1)
+
+    disparity_cap = 1.0 / max_depth
+    prediction_idepth_aligned[prediction_idepth_aligned < disparity_cap] = disparity_cap
+    prediciton_depth_aligned = 1.0 / prediction_idepth_aligned
+    prediciton_depth_aligned[sample_starts(counts)] = 1.0
+
+    return compute_errors_batch(valid_target, prediciton_depth_aligned, counts)
+
+
+class SparseDepth:
+    """Valid pixels of a ground truth depth map"""
+
+    def __init__(self, shape, rows, cols, depths):
+        """
+        Args:
+            shape: (height, width) of the depth map
+            rows: rows of the valid pixels
+            cols: columns of the valid pixels
+            depths: depths of the valid pixels
+        """
+        self.shape = tuple(shape)
+        self.rows = rows
+        self.cols = cols
+        self.depths = depths
+
+    @classmethod
+    def from_dense(cls, depth):
+        rows, cols = np.nonzero(depth > 0)
+        return cls(depth.shape, rows, cols, depth[rows, cols])
+
+    def to_dense(self):
+        """HxW depth map, zero on invalid pixels"""
+        depth = np.zeros(self.shape, dtype=self.depths.dtype)
+        depth[self.rows, self.cols] = self.depths
+        return depth
+
+
+class RunningErrors:
+    """Running float64 sums of the error metrics of the samples, in order"""
+
+    def __init__(self):
+        self.sums = np.zeros(7, dtype=np.float64)
+        self.count = 0
+
+    def update(self, errors):
+        """Add Nx7 errors of the next samples"""
+        # NOTE: one sample at a time, as the mean over the samples of numpy
+        for sample_errors in errors:
+            self.sums += sample_errors
+            self.count += 1
+
+    def mean(self):
+        return self.sums / self.count
+
+
+def evaluate_samples(predictions, targets, min_depth, max_depth):
+    """Errors of samples of any size, as align_and_compute_errors of each one
+    Args:
+        predictions: list of HxW predicted inverse depths
+        targets: list of HxW ground truth depths
+    Returns:
+        Nx7 errors, in the order of the samples
+    """
+    masks = [(target > min_depth) & (target < max_depth) for target in targets]
+    sizes = np.array([mask.size for mask in masks])
+    counts = np.array([np.count_nonzero(mask) for mask in masks])
+    # NOTE: samples are written into single buffers, without temporaries.
+    # Alignment terms are summed over whole maps, as compute_scale_and_shift,
+    # since the order of the values changes the rounding of the sums. Valid
+    # pixels of each sample follow a pixel of depth 1, see compute_errors_batch
+    prediction_dtype = np.result_type(*predictions)
+    target_dtype = np.result_type(*targets)
+    prediction_idepth = np.zeros(sizes.sum() + len(sizes), dtype=prediction_dtype)
+    target_idepth = np.zeros(sizes.sum() + len(sizes), dtype=target_dtype)
+    valid_prediction_idepth = np.ones(counts.sum() + len(counts), dtype=prediction_dtype)
+    valid_target = np.ones(counts.sum() + len(counts), dtype=target_dtype)
+    dense_starts = sample_starts(sizes) + 1
+    valid_starts = sample_starts(counts) + 1
+    for i, (prediction, target, mask) in enumerate(zip(predictions, targets, masks)):
+        mask = mask.ravel()
+        prediction = prediction.ravel()
+        target = target.ravel()
+        dense = slice(dense_starts[i], dense_starts[i] + sizes[i])
+        valid = slice(valid_starts[i], valid_starts[i] + counts[i])
+        pixels = np.flatnonzero(mask)
+        np.multiply(mask, prediction, out=prediction_idepth[dense])
+        np.take(prediction, pixels, out=valid_prediction_idepth[valid])
+        np.take(target, pixels, out=valid_target[valid])
+        target_idepth[dense][pixels] = 1.0 / valid_target[valid]
+    return align_and_compute_errors_batch(
+        prediction_idepth,
+        target_idepth,
+        valid_prediction_idepth,
+        valid_target,
+        sizes,
+        counts,
+        max_depth,
+    )
+
+
+class ErrorsReducer:
+    """Errors of chunks of samples, computed in process or by a pool of
+    workers, and reduced in the order of the chunks.
+    NOTE: workers return the errors of each sample of their chunks, 7 values
+    per sample, so that the reduction is the same for any number of workers,
+    and means are identical to the ones of a serial run
+    """
+
+    def __init__(self, min_depth, max_depth, workers=0):
+        """
+        Args:
+            min_depth: ground truth depths not above min_depth are invalid
+            max_depth: ground truth depths not below max_depth are invalid
+            workers: number of worker processes, 0 computes errors in process
+        """
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.running_errors = RunningErrors()
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.get_context("spawn").Pool(workers)
+        # NOTE: bounded, so that memory does not grow with the number of samples
+        self.max_pending = 2 * workers
+        self.pending = collections.deque()
+
+    def submit(self, predictions, targets):
+        """Add a chunk of samples, see evaluate_samples"""
+        args = (predictions, targets, self.min_depth, self.max_depth)
+        if self.pool is None:
+            self.running_errors.update(evaluate_samples(*args))
+            return
+        self.pending.append(self.pool.apply_async(evaluate_samples, args))
+        while len(self.pending) > self.max_pending:
+            self.running_errors.update(self.pending.popleft().get())
+
+    def mean(self):
+        """Wait for the pending chunks, and return the means of the errors"""
+        while self.pending:
+            self.running_errors.update(self.pending.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self.running_errors.mean()
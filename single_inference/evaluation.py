@@ -0,0 +1,182 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Evaluation engine shared by test_kitti.py, test_nyu.py and test_tum.py.
+Predictions go from the session to the error metrics in memory, and they are
+written as uint16 png only with --save_predictions.
+Each dataset is a loader with:
+    create_iterator(): initializable iterator over NxHxWx3 network inputs
+    names: names of the samples, used to save predictions
+    targets(): ground truth depths, in the order of the samples
+    min_depth: ground truth depths not above min_depth are invalid
+    sparse: if True, targets are eval_utils.SparseDepth, restored as dense
+        maps to compute errors
+"""
+import os
+
+import cv2
+import numpy as np
+import tensorflow as tf
+from tqdm import tqdm
+
+from eval_utils import ErrorsReducer
+from network import Pydnet
+from predictor import build_postprocessing, load_network_config, padded_size
+
+LABELS = ["abs_rel", "sq_rel", "rmse", "rmse_log", "a1", "a2", "a3"]
+
+
+def add_arguments(parser, dest, max_depth):
+    """ Arguments shared by the test scripts """
+    parser.add_argument("--ckpt", type=str, help="path to checkpoint", required=True)
+    parser.add_argument("--dest", type=str, help="prediction folder", default=dest)
+    parser.add_argument(
+        "--save_predictions",
+        action="store_true",
+        help="save predictions in the prediction folder, as uint16 png",
+    )
+    parser.add_argument(
+        "--max_depth", type=float, help="maximum depth value", default=max_depth
+    )
+    parser.add_argument("--height", type=int, help="height of the network input", default=320)
+    parser.add_argument("--width", type=int, help="width of the network input", default=640)
+    parser.add_argument(
+        "--network_config", type=str, help="json with additional network params"
+    )
+    parser.add_argument(
+        "--in_graph_postprocessing",
+        action="store_true",
+        help="normalize, resize and quantize predictions inside the graph",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=["float32", "float16"],
+        help="compute precision, run both to check accuracy parity",
+        default="float32",
+    )
+    parser.add_argument(
+        "--metrics_batch_size",
+        type=int,
+        help="predictions whose errors are computed together, as a chunk of work",
+        default=4,
+    )
+    parser.add_argument(
+        "--eval_workers",
+        type=int,
+        help="processes computing the errors while the network runs, 0 for none",
+        default=0,
+    )
+
+
+def check_options(opts):
+    if opts.height < 1 or opts.width < 1:
+        raise ValueError("height and width must be greater than 0")
+
+
+def pad_to_stride(img):
+    """Pad a HxWx3 image to a multiple of the network stride, replicating the
+    last row and column as PredictorCache. Predictions are cropped back by
+    evaluate"""
+    height, width, _ = img.shape.as_list()
+    padded_height, padded_width = padded_size(height), padded_size(width)
+    if padded_height > height:
+        img = tf.concat([img, tf.tile(img[-1:], [padded_height - height, 1, 1])], 0)
+    if padded_width > width:
+        img = tf.concat([img, tf.tile(img[:, -1:], [1, padded_width - width, 1])], 1)
+    img.set_shape([padded_height, padded_width, 3])
+    return img
+
+
+def evaluate(loader, opts):
+    """Run the model on a dataset and compute error metrics, returning their means.
+    Predictions are normalized in [0, 255] before the alignment, as the
+    predictions saved by the test scripts, but they are not quantized, unless
+    the post-processing runs in the graph.
+    """
+    network_params = load_network_config(opts.network_config)
+    # NOTE: loaders pad images to a multiple of the network stride
+    network_params.update(
+        {
+            "height": padded_size(opts.height),
+            "width": padded_size(opts.width),
+            "is_training": False,
+            "precision": opts.precision,
+        }
+    )
+    # NOTE: workers start while the graph is built and restored
+    errors_reducer = ErrorsReducer(loader.min_depth, opts.max_depth, opts.eval_workers)
+
+    iterator = loader.create_iterator()
+    batch_img = iterator.get_next()
+
+    network = Pydnet(network_params)
+    predicted_idepth = network.forward(batch_img)
+    predicted_idepth = tf.nn.relu(predicted_idepth)
+    predicted_idepth = predicted_idepth[:, : opts.height, : opts.width]
+    if opts.in_graph_postprocessing:
+        _, tensor_size, encoded_idepth = build_postprocessing(predicted_idepth, "uint16")
+
+    # restore graph
+    saver = tf.train.Saver()
+    sess = tf.Session()
+    sess.run(tf.compat.v1.global_variables_initializer())
+    sess.run(iterator.initializer)
+    saver.restore(sess, opts.ckpt)
+
+    if opts.save_predictions:
+        os.makedirs(opts.dest, exist_ok=True)
+
+    predictions = []
+    targets = []
+    samples = zip(loader.names, loader.targets())
+    for name, target in tqdm(samples, total=len(loader.names)):
+        # NOTE: predictions are resized to the size of the ground truth
+        h, w = target.shape[:2]
+        if opts.in_graph_postprocessing:
+            encoded_idepth_value = sess.run(encoded_idepth, feed_dict={tensor_size: (h, w)})[0]
+            prediction_idepth = encoded_idepth_value / 256.0
+        else:
+            idepth = sess.run(predicted_idepth)
+            idepth = np.squeeze(idepth)
+            min_idepth = idepth.min()
+            max_idepth = idepth.max()
+            norm_idepth = (idepth - min_idepth) / (max_idepth - min_idepth)
+            norm_idepth *= 255.0
+            norm_idepth = cv2.resize(norm_idepth, (w, h))
+            prediction_idepth = norm_idepth.astype(np.float64)
+
+        if opts.save_predictions:
+            if not opts.in_graph_postprocessing:
+                encoded_idepth_value = (norm_idepth * 256.0).astype(np.uint16)
+            cv2.imwrite(os.path.join(opts.dest, f"{name}.png"), encoded_idepth_value)
+
+        # NOTE: errors are the ones of the dense ground truth, bit-for-bit
+        predictions.append(prediction_idepth)
+        targets.append(target.to_dense() if loader.sparse else target)
+        if len(predictions) == opts.metrics_batch_size:
+            errors_reducer.submit(predictions, targets)
+            predictions = []
+            targets = []
+    sess.close()
+    if predictions:
+        errors_reducer.submit(predictions, targets)
+
+    mean_errors = errors_reducer.mean()
+    for i in range(len(LABELS)):
+        print(f"{LABELS[i]}:{mean_errors[i]}")
+
+    print("Evaluation done!")
+    return dict(zip(LABELS, mean_errors))
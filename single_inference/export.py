@@ -17,9 +17,14 @@ Export a trained tensorflow model into various formats.
 Outputs:
     mlmodel: for ios devices
     tflite: for android devices
+    quantized tflite: dynamic range, full integer or float16, for android and arm devices
+    onnx: for onnxruntime and other onnx runtimes, with --onnx
     pb: protobuffer, for generic purposes
 """
 import sys
+import glob
+import time
+import collections
 
 sys.path.insert(0, ".")
 import tensorflow as tf
@@ -30,7 +35,15 @@ from tensorflow.python.platform import gfile
 from tensorflow.python.tools import freeze_graph
 from tensorflow.python.tools import optimize_for_inference_lib
 from tensorflow.python.saved_model import tag_constants
+import numpy as np
+import cv2
 import network
+from predictor import (
+    TFLitePredictor,
+    load_network_config,
+    prepare_frame,
+    tflite_interpreter,
+)
 import tfcoreml
 import coremltools
 import coremltools.proto.FeatureTypes_pb2 as ft
@@ -51,11 +64,219 @@ parser.add_argument(
 )
 parser.add_argument("--height", type=int, default=384, help="height of image")
 parser.add_argument("--width", type=int, default=640, help="width of image")
+parser.add_argument(
+    "--exit_level",
+    type=int,
+    choices=range(1, 7),
+    default=1,
+    help="finest level of the decoder, higher levels are faster but coarser",
+)
+parser.add_argument(
+    "--fused_upsampling",
+    action="store_true",
+    help="fold bilinear upsampling and convolution of the decoder in a single op",
+)
+parser.add_argument(
+    "--network_config",
+    type=str,
+    help="json with additional network params, e.g. channels of a pruned checkpoint",
+)
+parser.add_argument(
+    "--quantization",
+    type=str,
+    default="",
+    help="comma separated list of quantized tflite models to export, among "
+    "dynamic (int8 weights), int8 (int8 weights and activations) and "
+    "float16 (float16 weights)",
+)
+parser.add_argument(
+    "--calibration",
+    type=str,
+    help="images used to calibrate int8 quantization: a folder, or a txt file "
+    "with a path for each line (e.g. test_kitti.txt)",
+)
+parser.add_argument(
+    "--calibration_root", type=str, default="", help="root of paths in calibration file"
+)
+parser.add_argument(
+    "--calibration_samples",
+    type=int,
+    default=100,
+    help="maximum number of calibration images",
+)
+parser.add_argument(
+    "--onnx",
+    action="store_true",
+    help="export the onnx model too (pip install tf2onnx)",
+)
+parser.add_argument(
+    "--onnx_opset", type=int, default=10, help="opset of the onnx model"
+)
+parser.add_argument(
+    "--onnx_simplify",
+    action="store_true",
+    help="simplify the onnx model with onnx-simplifier (pip install onnx-simplifier)",
+)
 parser.add_argument(
     "--debug", action="store_true", help="active debug and visualize graph nodes"
 )
 args = parser.parse_args()
 
+QUANTIZATIONS = ["dynamic", "int8", "float16"]
+
+
+def read_calibration_list(calibration, root, max_samples):
+    """ List the calibration images, evenly sampled
+    Args:
+        calibration: folder of images, or txt file with a path for each line
+        root: root of the paths in the txt file
+        max_samples: maximum number of images
+    """
+    if os.path.isdir(calibration):
+        paths = glob.glob(os.path.join(calibration, "*.png"))
+        paths += glob.glob(os.path.join(calibration, "*.jpg"))
+    else:
+        with open(calibration, "r") as f:
+            lines = [l.strip() for l in f.readlines() if l.strip()]
+        # NOTE: KITTI lists, e.g. test_kitti.txt, omit the jpg extension
+        paths = [
+            os.path.join(root, l if os.path.splitext(l)[1] else l + ".jpg")
+            for l in lines
+        ]
+    paths = sorted(paths)
+    if len(paths) == 0:
+        raise ValueError("No calibration images found in {}".format(calibration))
+    step = max(len(paths) // max_samples, 1)
+    return paths[::step][:max_samples]
+
+
+def representative_dataset(paths, height, width):
+    """ Generator of calibration inputs, prepared as in inference.py """
+
+    def generator():
+        for path in paths:
+            img, _ = prepare_frame(cv2.imread(path), height, width)
+            yield [np.expand_dims(img, 0)]
+
+    return generator
+
+
+def convert_tflite(frozen_graph_path, params, quantization=None, calibration=None):
+    """ Convert the frozen graph into a tflite model
+    Args:
+        frozen_graph_path: path to frozen graph
+        params: export params, with input and output nodes
+        quantization: None for float model, or one of QUANTIZATIONS
+        calibration: generator of calibration inputs, required by int8
+    Returns:
+        the serialized tflite model
+    """
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(
+        frozen_graph_path, params["input_nodes"], params["output_nodes"]
+    )
+    if quantization is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "int8":
+        # NOTE: inputs and outputs stay float, quantized inside the model.
+        # Ops without int8 kernels in the converter, e.g. the normalization of
+        # make_visual after the last LEAKY_RELU, fall back to float ones
+        converter.representative_dataset = calibration
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+            tf.lite.OpsSet.TFLITE_BUILTINS,
+        ]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.lite.constants.FLOAT16]
+    return converter.convert()
+
+
+def float_tensors(tflite_path):
+    """ Names of the float32 tensors of a tflite model, except its inputs and
+    outputs, i.e. the tensors computed by ops that were not quantized """
+    interpreter = tflite_interpreter()(model_path=tflite_path)
+    boundary = [
+        details["index"]
+        for details in interpreter.get_input_details() + interpreter.get_output_details()
+    ]
+    return [
+        details["name"]
+        for details in interpreter.get_tensor_details()
+        if details["dtype"] == np.float32 and details["index"] not in boundary
+    ]
+
+
+def convert_onnx(frozen_graph_path, params, opset, simplify=False):
+    """ Convert the frozen graph into an onnx model
+    Args:
+        frozen_graph_path: path to frozen graph
+        params: export params, with input and output nodes
+        opset: onnx opset
+        simplify: if True, simplify the model with onnx-simplifier
+    Returns:
+        the onnx model
+    """
+    import tf2onnx
+
+    graph_def = tf.GraphDef()
+    with gfile.GFile(frozen_graph_path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    input_names = [name + ":0" for name in params["input_nodes"]]
+    output_names = params["output_nodes_port"]
+    # NOTE: fold constants of the tensorflow graph before conversion
+    graph_def = tf2onnx.tfonnx.tf_optimize(input_names, output_names, graph_def, True)
+    with tf.Graph().as_default() as tf_graph:
+        tf.import_graph_def(graph_def, name="")
+    onnx_graph = tf2onnx.tfonnx.process_tf_graph(
+        tf_graph, opset=opset, input_names=input_names, output_names=output_names
+    )
+    onnx_graph = tf2onnx.optimizer.optimize_graph(onnx_graph)
+    model = onnx_graph.make_model(params["arch"])
+    if simplify:
+        from onnxsim import simplify as simplify_onnx
+
+        model, check = simplify_onnx(model)
+        if not check:
+            raise ValueError("simplified onnx model does not match the original")
+    return model
+
+
+def measure_latency(tflite_path, runs=20):
+    """ Mean latency of a tflite model on a random input, in seconds """
+    predictor = TFLitePredictor(tflite_path)
+    shape = (1, predictor.height, predictor.width, 3)
+    batch_img = np.random.uniform(size=shape).astype(np.float32)
+    predictor.predict(batch_img)
+    start = time.perf_counter()
+    for _ in range(runs):
+        predictor.predict(batch_img)
+    return (time.perf_counter() - start) / runs
+
+
+def report_quantization(tflite_paths):
+    """ Print size and latency of quantized models with respect to the float one
+    Args:
+        tflite_paths: dictionary from model name to path, float model first
+    """
+    print("=> quantization report")
+    header = ("model", "size (MB)", "ratio", "latency (ms)", "speedup")
+    print("{:<10}{:>12}{:>10}{:>14}{:>10}".format(*header))
+    reference_size = None
+    reference_latency = None
+    for name, path in tflite_paths.items():
+        size = os.path.getsize(path) / 2 ** 20
+        latency = measure_latency(path)
+        if reference_size is None:
+            reference_size, reference_latency = size, latency
+        print(
+            "{:<10}{:>12.2f}{:>10.2f}{:>14.2f}{:>10.2f}".format(
+                name,
+                size,
+                reference_size / size,
+                latency * 1000.0,
+                reference_latency / latency,
+            )
+        )
+
 
 def main(_):
     params = {
@@ -73,19 +294,32 @@ def main(_):
         "frozen_graph_name": "frozen_" + args.arch + ".pb",
         "optimized_graph_name": "optimized_" + args.arch + ".pb",
         "optimized_tflite_name": "tflite_" + args.arch + ".tflite",
+        "quantized_tflite_name": "tflite_" + args.arch + "_{}.tflite",
         "clear_devices": True,
     }
 
+    quantizations = [q for q in args.quantization.split(",") if q]
+    for quantization in quantizations:
+        if quantization not in QUANTIZATIONS:
+            raise ValueError("Unknown quantization {}".format(quantization))
+    if "int8" in quantizations and args.calibration is None:
+        raise ValueError("int8 quantization requires calibration images")
+
     if not os.path.exists(params["output"]):
         os.makedirs(params["output"])
 
     with tf.Graph().as_default():
 
-        network_params = {
-            "height": args.height,
-            "width": args.width,
-            "is_training": False,
-        }
+        network_params = load_network_config(args.network_config)
+        network_params.update(
+            {
+                "height": args.height,
+                "width": args.width,
+                "is_training": False,
+                "exit_level": args.exit_level,
+                "fused_upsampling": args.fused_upsampling,
+            }
+        )
         input_node = "im0"
         input_tensor = tf.placeholder(
             tf.float32,
@@ -136,16 +370,53 @@ def main(_):
                 "",
             )
 
-            converter = tf.lite.TFLiteConverter.from_frozen_graph(
-                frozen_graph_path, params["input_nodes"], params["output_nodes"]
-            )
-            tflite_model = converter.convert()
+            tflite_model = convert_tflite(frozen_graph_path, params)
             optimized_tflite_path = os.path.join(
                 params["output"], params["optimized_tflite_name"]
             )
             with open(optimized_tflite_path, "wb") as f:
                 f.write(tflite_model)
 
+            tflite_paths = collections.OrderedDict([("float", optimized_tflite_path)])
+            calibration = None
+            if args.calibration is not None:
+                calibration_list = read_calibration_list(
+                    args.calibration, args.calibration_root, args.calibration_samples
+                )
+                print("=> {} calibration images".format(len(calibration_list)))
+                calibration = representative_dataset(
+                    calibration_list, network_params["height"], network_params["width"]
+                )
+            for quantization in quantizations:
+                print("=> exporting {} quantized tflite".format(quantization))
+                tflite_model = convert_tflite(
+                    frozen_graph_path, params, quantization, calibration
+                )
+                quantized_tflite_path = os.path.join(
+                    params["output"], params["quantized_tflite_name"].format(quantization)
+                )
+                with open(quantized_tflite_path, "wb") as f:
+                    f.write(tflite_model)
+                tflite_paths[quantization] = quantized_tflite_path
+                if quantization == "int8":
+                    names = float_tensors(quantized_tflite_path)
+                    print(
+                        "=> {} float tensors in int8 model: {}".format(
+                            len(names), ", ".join(names) or "none"
+                        )
+                    )
+            if quantizations:
+                report_quantization(tflite_paths)
+
+            if args.onnx:
+                print("=> exporting onnx model, opset {}".format(args.onnx_opset))
+                onnx_model = convert_onnx(
+                    frozen_graph_path, params, args.onnx_opset, args.onnx_simplify
+                )
+                onnx_path = os.path.join(params["output"], params["onnx"])
+                with open(onnx_path, "wb") as f:
+                    f.write(onnx_model.SerializeToString())
+
     mlmodel_path = os.path.join(params["output"], params["mlmodel"])
     mlmodel = tfcoreml.convert(
         tf_model_path=frozen_graph_path,
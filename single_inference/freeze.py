@@ -0,0 +1,72 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pack a checkpoint into a single frozen graph, loaded by the frozen backend
+of inference.py without building the network nor restoring variables.
+
+Usage:
+    python freeze.py --ckpt ckpt/pydnet --dest ckpt/pydnet.pb
+"""
+import argparse
+import os
+
+from predictor import freeze, load_network_config
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Freeze a checkpoint for inference")
+    parser.add_argument("--ckpt", type=str, help="path to checkpoint", required=True)
+    parser.add_argument("--dest", type=str, help="path of the frozen graph", required=True)
+    parser.add_argument("--height", type=int, help="height of the network input", default=320)
+    parser.add_argument("--width", type=int, help="width of the network input", default=640)
+    parser.add_argument(
+        "--exit_level", type=int, choices=range(1, 7), help="finest decoder level", default=1
+    )
+    parser.add_argument(
+        "--fused_upsampling",
+        action="store_true",
+        help="fold bilinear upsampling and convolution of the decoder in a single op",
+    )
+    parser.add_argument(
+        "--network_config",
+        type=str,
+        help="json with additional network params, e.g. channels of a pruned checkpoint",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=["float32", "float16"],
+        help="compute precision of the network",
+        default="float32",
+    )
+    opts = parser.parse_args()
+
+    network_options = load_network_config(opts.network_config)
+    network_options.update(
+        {
+            "exit_level": opts.exit_level,
+            "fused_upsampling": opts.fused_upsampling,
+            "precision": opts.precision,
+        }
+    )
+    freeze(opts.ckpt, opts.dest, opts.height, opts.width, network_options)
+    print("=> saved {}".format(opts.dest))
+
+
+if __name__ == "__main__":
+    main()
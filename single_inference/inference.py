@@ -13,40 +13,279 @@
 # limitations under the License.
 
 
-import tensorflow as tf
+import time
+
+# NOTE: reference for the startup report, taken before any other import
+START_TIME = time.perf_counter()
+
 import cv2
 import numpy as np
 import os
 import argparse
 import glob
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-import matplotlib.pyplot as plt
-import network
-from tensorflow.python.util import deprecation
+import stream
+import tiling
+from predictor import (
+    BACKENDS,
+    ONNX_OPTIMIZATIONS,
+    PredictorCache,
+    create_predictor,
+    import_tensorflow,
+    load_network_config,
+    padded_size,
+    prepare_frame,
+)
+from colormap import OUTPUT_FORMATS, encode_depth, normalize
+from profiling import StageTimer
 
 # disable future warnings and info messages for this demo
+# NOTE: tensorflow is imported only by the backends that need it
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
 parser = argparse.ArgumentParser(description="Single shot depth estimator")
 parser.add_argument(
-    "--img", type=str, help="path to reference RGB image", required=True
+    "--img",
+    type=str,
+    help="path to reference RGB image, folder of images or stream (see --stream)",
+    required=True,
+)
+parser.add_argument("--ckpt", type=str, help="path to checkpoint")
+parser.add_argument(
+    "--backend", type=str, choices=BACKENDS, help="inference backend", default="tf"
+)
+parser.add_argument(
+    "--tflite", type=str, help="path to tflite model, required by tflite backend"
+)
+parser.add_argument(
+    "--frozen", type=str, help="path to frozen graph, required by frozen backend"
+)
+parser.add_argument(
+    "--onnx", type=str, help="path to onnx model, required by onnx backend"
+)
+parser.add_argument(
+    "--onnx_optimization",
+    type=str,
+    choices=list(ONNX_OPTIMIZATIONS),
+    help="graph optimization level of onnxruntime",
+    default="all",
+)
+parser.add_argument(
+    "--num_threads", type=int, help="number of threads used by the backend"
+)
+parser.add_argument(
+    "--inter_op_threads",
+    type=int,
+    help="number of inter-op threads, for tf, frozen and onnx backends",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    help="number of processes sharing the images of a folder, each one with its "
+    "own model. By default, the cores are split among workers (see --num_threads)",
+    default=1,
+)
+parser.add_argument(
+    "--cpu_affinity",
+    action="store_true",
+    help="with --workers, pin each worker to its own cores (linux only)",
+)
+parser.add_argument(
+    "--scaling_report",
+    action="store_true",
+    help="run the folder with 1, 2, 4, ... up to --workers processes and report "
+    "the throughput of each",
 )
-parser.add_argument("--ckpt", type=str, help="path to checkpoint", required=True)
 parser.add_argument("--cpu", action="store_true", help="run on cpu")
+parser.add_argument(
+    "--height", type=int, help="height of the network input", default=320
+)
+parser.add_argument(
+    "--width", type=int, help="width of the network input", default=640
+)
+parser.add_argument(
+    "--exit_level",
+    type=int,
+    choices=range(1, 7),
+    help="finest level of the decoder, higher levels are faster but coarser",
+    default=1,
+)
+parser.add_argument(
+    "--fused_upsampling",
+    action="store_true",
+    help="fold bilinear upsampling and convolution of the decoder in a single op",
+)
+parser.add_argument(
+    "--network_config",
+    type=str,
+    help="json with additional network params, e.g. channels of a pruned checkpoint",
+)
+parser.add_argument(
+    "--precision",
+    type=str,
+    choices=["float32", "float16"],
+    help="compute precision of the network, weights are cast when loaded",
+    default="float32",
+)
+parser.add_argument(
+    "--batch_size", type=int, help="number of images processed per run", default=1
+)
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    help="number of threads used to decode and to write images",
+    default=4,
+)
+parser.add_argument(
+    "--prefetch", type=int, help="number of batches decoded in advance", default=2
+)
 parser.add_argument(
     "--original_size", action="store_true", help="if true, restore original image size"
 )
+parser.add_argument(
+    "--output_format",
+    type=str,
+    choices=OUTPUT_FORMATS,
+    help="color to save depth with magma colormap, uint8 or uint16 to save raw depth",
+    default="color",
+)
+parser.add_argument(
+    "--in_graph_postprocessing",
+    action="store_true",
+    help="normalize, resize and encode depth inside the graph, so that the "
+    "session returns images ready to be saved. Only for tf backend",
+)
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="if true, img is a video file or an image sequence (e.g. frames/%%06d.png)",
+)
+parser.add_argument(
+    "--stream_output",
+    type=str,
+    choices=["video", "frames"],
+    help="save stream results as video or as sequence of images",
+    default="video",
+)
+parser.add_argument(
+    "--tiled",
+    action="store_true",
+    help="predict depth at the resolution of each image, running overlapping "
+    "tiles of the network size. Results have the original size",
+)
+parser.add_argument(
+    "--tile_batch_size",
+    type=int,
+    help="number of tiles run together, it bounds the memory of the network",
+    default=4,
+)
+parser.add_argument(
+    "--tile_overlap",
+    type=int,
+    help="minimum overlap between tiles, in pixels",
+    default=64,
+)
+parser.add_argument(
+    "--motion_threshold",
+    type=float,
+    help="in stream mode, skip the network on frames whose mean absolute "
+    "difference from the last processed one is below this threshold (e.g. 0.02), "
+    "reusing its depth. 0 disables skipping",
+    default=0.0,
+)
+parser.add_argument(
+    "--refresh_interval",
+    type=int,
+    help="with --motion_threshold, run the network at least once every N frames",
+    default=30,
+)
+parser.add_argument(
+    "--motion_audit",
+    type=int,
+    help="with --motion_threshold, run the network anyway on one skipped frame "
+    "every N, to report the error of the reused depth. 0 disables it",
+    default=0,
+)
 parser.add_argument(
     "--dest",
     type=str,
     help="path to result folder. If not exists, it will be created",
     default="results",
 )
+parser.add_argument(
+    "--report_startup",
+    action="store_true",
+    help="print the time spent in each stage until the first depth map is saved",
+)
+parser.add_argument(
+    "--profile",
+    action="store_true",
+    help="measure the time of each stage for each image of a folder",
+)
+parser.add_argument(
+    "--profile_output",
+    type=str,
+    help="save the times measured by --profile as csv or json (by extension)",
+)
+parser.add_argument(
+    "--trace_iterations",
+    type=str,
+    help="comma separated list of batches whose tensorflow step stats are saved "
+    "in dest as chrome traces",
+    default="",
+)
+
+# NOTE: disabled unless --profile is set
+timer = StageTimer(enabled=False)
 
-opts = parser.parse_args()
-if opts.cpu:
-    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+class StartupReport(object):
+    """ Wall time of the startup stages, since the import of this module """
+
+    def __init__(self):
+        self.last = START_TIME
+        self.stages = []
+
+    def mark(self, stage):
+        """ Close the current stage """
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def show(self):
+        print("=> startup report")
+        for stage, elapsed in self.stages:
+            print("{:<24}{:>10.3f}s".format(stage, elapsed))
+        print("{:<24}{:>10.3f}s".format("total", self.last - START_TIME))
+
+
+def load_predictor(num_threads=None, inter_op_threads=None):
+    """ Create the predictor selected by the command line """
+    network_options = load_network_config(opts.network_config)
+    network_options.update(
+        {
+            "exit_level": opts.exit_level,
+            "fused_upsampling": opts.fused_upsampling,
+            "precision": opts.precision,
+        }
+    )
+    return create_predictor(
+        opts.backend,
+        opts.ckpt,
+        opts.tflite,
+        num_threads=num_threads,
+        height=opts.height,
+        width=opts.width,
+        frozen=opts.frozen,
+        network_options=network_options,
+        onnx=opts.onnx,
+        onnx_optimization=opts.onnx_optimization,
+        output_format=opts.output_format if opts.in_graph_postprocessing else None,
+        inter_op_threads=inter_op_threads,
+    )
 
 
 def create_dir(d):
@@ -58,10 +297,382 @@ def create_dir(d):
         os.makedirs(d)
 
 
-def main(_):
-    network_params = {"height": 320, "width": 640, "is_training": False}
+def output_path(key):
+    """ Path of the depth of an image, given its name """
+    return os.path.join(opts.dest, key.split(".")[0] + "_depth.png")
+
+
+def prepare_image(path, height, width):
+    """ Read an image and prepare it for the network
+    Args:
+        path: path to the image
+        height: height of the network input
+        width: width of the network input
+    Returns:
+        the normalized RGB image and its original (height, width)
+    """
+    key = os.path.basename(path)
+    with timer.measure(key, "decode"):
+        img = cv2.imread(path)
+    with timer.measure(key, "preprocess"):
+        return prepare_frame(img, height, width)
+
+
+def prefetch_batches(img_list, batch_size, executor, prefetch, shape):
+    """ Generate batches of prepared images. Upcoming batches are decoded
+    by the executor while the current one is consumed
+    Args:
+        img_list: list of image paths
+        batch_size: number of images in each batch
+        executor: executor used to prepare the images
+        prefetch: number of batches prepared in advance
+        shape: (height, width) of the network input
+    Returns:
+        a generator of (paths, stacked images, original shapes)
+    """
+    pending = collections.deque()
+
+    def collect():
+        paths, futures = pending.popleft()
+        samples = [f.result() for f in futures]
+        batch_img = np.stack([img for img, _ in samples], 0)
+        return paths, batch_img, [shape for _, shape in samples]
+
+    for start in range(0, len(img_list), batch_size):
+        paths = img_list[start : start + batch_size]
+        futures = [executor.submit(prepare_image, p, *shape) for p in paths]
+        pending.append((paths, futures))
+        if len(pending) > prefetch:
+            yield collect()
+    while pending:
+        yield collect()
+
+
+def finalize_depth(depth, shape):
+    """ Prepare the final depth, restoring the original size if required
+    Args:
+        depth: depth predicted by the network
+        shape: original (height, width) of the image
+    """
+    if opts.original_size:
+        h, w = shape
+        depth = cv2.resize(depth, (w, h))
+    return depth
+
+
+def save_depth(depth, shape, dest, key):
+    """ Save a predicted depth, normalized and colored if required
+    Args:
+        depth: depth predicted by the network
+        shape: original (height, width) of the image
+        dest: path of the output image
+        key: name of the image, for timing
+    """
+    with timer.measure(key, "original_size"):
+        depth = finalize_depth(depth, shape)
+    with timer.measure(key, "normalize"):
+        depth = normalize(depth)
+    with timer.measure(key, "encode"):
+        depth = encode_depth(depth, opts.output_format, normalized=True)
+    save_encoded(depth, dest, key)
+
+
+def save_encoded(image, dest, key):
+    """ Save a depth already encoded as image, e.g. by the graph
+    Args:
+        image: image as colormap.encode_depth
+        dest: path of the output image
+        key: name of the image, for timing
+    """
+    with timer.measure(key, "png_encode"):
+        ok, data = cv2.imencode(".png", image)
+        if not ok:
+            raise ValueError("Cannot encode {}".format(dest))
+    with timer.measure(key, "write"):
+        with open(dest, "wb") as f:
+            f.write(data.tobytes())
+
+
+def predict_encoded(predictor, batch_img, batch_shapes):
+    """ Run the network with the post-processing of the graph.
+    With --original_size, images of a batch with the same original size are
+    run together
+    Returns:
+        list of images as colormap.encode_depth
+    """
+    if not opts.original_size:
+        return list(predictor.predict_encoded(batch_img))
+    images = [None] * len(batch_img)
+    for shape in set(batch_shapes):
+        indices = [i for i, s in enumerate(batch_shapes) if s == shape]
+        batch_encoded = predictor.predict_encoded(batch_img[indices], size=shape)
+        for i, image in zip(indices, batch_encoded):
+            images[i] = image
+    return images
+
+
+def report_first_batch(startup, pending_writes):
+    """ Wait for the first batch to be saved and print the startup report """
+    for write in pending_writes:
+        write.result()
+    startup.mark("first depth map")
+    startup.show()
+
+
+def run_stream(predictor, startup):
+    """ Run the network over a video or an image sequence.
+    Frames are read and written by background threads through bounded
+    queues, so memory does not grow with the length of the stream
+    """
+    name = os.path.basename(opts.img)
+    if "%" in name:
+        name = os.path.basename(os.path.dirname(os.path.abspath(opts.img)))
+    name = name.split(".")[0]
+    if opts.stream_output == "video":
+        fps = stream.get_fps(opts.img)
+        dest = os.path.join(opts.dest, name + "_depth.mp4")
+        depth_writer = stream.VideoDepthWriter(dest, fps, opts.output_format)
+    else:
+        dest = os.path.join(opts.dest, name + "_depth")
+        depth_writer = stream.FramesDepthWriter(dest, opts.output_format)
+
+    queue_size = max(opts.prefetch, 1) * opts.batch_size
+    frames = (
+        prepare_frame(frame, predictor.height, predictor.width)
+        for frame in stream.read_frames(opts.img)
+    )
+    frames = stream.iterate_in_background(frames, queue_size)
+    gate = None
+    if opts.motion_threshold > 0:
+        gate = stream.MotionGate(
+            opts.motion_threshold, opts.refresh_interval, opts.motion_audit
+        )
+
+    # NOTE: a single writer thread keeps the order of the frames
+    with ThreadPoolExecutor(1) as writer:
+        pending_writes = collections.deque()
+        for batch in tqdm(stream.batched(frames, opts.batch_size), unit="batch"):
+            batch_img = np.stack([img for img, _ in batch], 0)
+            if gate is None:
+                batch_depth = predictor.predict(batch_img)
+            else:
+                batch_depth = gate.predict(predictor, batch_img)
+            for depth, (_, shape) in zip(batch_depth, batch):
+                depth = finalize_depth(depth, shape)
+                pending_writes.append(writer.submit(depth_writer.write, depth))
 
-    if os.path.isfile(opts.img):
+            if opts.report_startup and startup is not None:
+                report_first_batch(startup, pending_writes)
+                startup = None
+
+            while len(pending_writes) > queue_size:
+                pending_writes.popleft().result()
+
+        for write in pending_writes:
+            write.result()
+    depth_writer.close()
+    print("=> saved {}".format(dest))
+    if gate is not None:
+        print(gate.summary())
+
+
+def report_profile(start, num_images):
+    """ Print (and save) the times measured by --profile, if set """
+    if not opts.profile:
+        return
+    elapsed = time.perf_counter() - start
+    print("=> {:.3f}s, {:.2f} images/s".format(elapsed, num_images / elapsed))
+    print("NOTE: stages run concurrently, the sum of their times exceeds wall time")
+    timer.summary()
+    if opts.profile_output:
+        timer.dump(opts.profile_output)
+        print("=> saved {}".format(opts.profile_output))
+
+
+def run_tiled(predictor, img_list):
+    """ Run the network over overlapping tiles of each image, see tiling.py.
+    Images are processed one at a time, tiles of an image are batched
+    """
+    with ThreadPoolExecutor(opts.num_workers) as writer:
+        pending_writes = collections.deque()
+        for path in tqdm(img_list):
+            key = os.path.basename(path)
+            with timer.measure(key, "decode"):
+                img = cv2.imread(path)
+            with timer.measure(key, "preprocess"):
+                h, w = img.shape[:2]
+                img, shape = prepare_frame(img, h, w)
+            with timer.measure(key, "inference"):
+                depth = tiling.predict_tiled(
+                    predictor, img, opts.tile_batch_size, opts.tile_overlap
+                )
+            dest = output_path(key)
+            pending_writes.append(writer.submit(save_depth, depth, shape, dest, key))
+
+            # NOTE: full resolution depths are large, few of them are kept
+            while len(pending_writes) > opts.num_workers:
+                pending_writes.popleft().result()
+
+        for write in pending_writes:
+            write.result()
+
+
+# NOTE: predictor of a worker process and error raised loading it, see
+# init_worker
+worker_predictor = None
+worker_error = None
+
+
+def init_worker(worker_opts, workers, cores_queue, barrier):
+    """ Load the predictor of a worker process, pinned to its cores if
+    required. Workers wait each other, so that no image is processed before
+    all the models are loaded
+    """
+    global opts, worker_predictor, worker_error
+    opts = worker_opts
+    try:
+        cores = cores_queue.get()
+        if cores:
+            os.sched_setaffinity(0, cores)
+        num_threads, inter_op_threads = worker_threads(workers)
+        worker_predictor = load_predictor(num_threads, inter_op_threads)
+    except Exception as e:
+        # NOTE: the pool restarts workers failing here, so the error is
+        # raised by run_shard instead
+        worker_error = e
+    barrier.wait()
+
+
+def worker_threads(workers):
+    """ Intra-op and inter-op threads of each worker. If not set, the cores
+    are split among workers, and each session runs one op at a time """
+    num_threads = opts.num_threads
+    if num_threads is None:
+        num_threads = max(multiprocessing.cpu_count() // workers, 1)
+    inter_op_threads = opts.inter_op_threads
+    if inter_op_threads is None:
+        inter_op_threads = 1
+    return num_threads, inter_op_threads
+
+
+def worker_cores(workers):
+    """ Disjoint sets of cores of each worker, or None if not pinned """
+    if not opts.cpu_affinity:
+        return [None] * workers
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < workers:
+        print("WARNING: {} workers on {} cores, not pinned".format(workers, len(cores)))
+        return [None] * workers
+    return [[int(c) for c in chunk] for chunk in np.array_split(cores, workers)]
+
+
+def run_shard(paths):
+    """ Run the network over a shard of images, in a worker process """
+    if worker_error is not None:
+        raise worker_error
+    samples = [
+        prepare_image(p, worker_predictor.height, worker_predictor.width)
+        for p in paths
+    ]
+    batch_img = np.stack([img for img, _ in samples], 0)
+    batch_depth = worker_predictor.predict(batch_img)
+    for path, depth, (_, shape) in zip(paths, batch_depth, samples):
+        key = os.path.basename(path)
+        save_depth(depth, shape, output_path(key), key)
+    return len(paths)
+
+
+def run_workers(img_list, workers):
+    """ Shard the images across worker processes, each one with its own
+    predictor. Shards of batch_size images are completed in order, so
+    progress is reported as in a single process
+    Returns:
+        seconds spent on the images, after all the models are loaded
+    """
+    context = multiprocessing.get_context("spawn")
+    cores_queue = context.Queue()
+    for cores in worker_cores(workers):
+        cores_queue.put(cores)
+    barrier = context.Barrier(workers + 1)
+    shards = [
+        img_list[start : start + opts.batch_size]
+        for start in range(0, len(img_list), opts.batch_size)
+    ]
+    with context.Pool(
+        workers, initializer=init_worker, initargs=(opts, workers, cores_queue, barrier)
+    ) as pool:
+        barrier.wait()
+        start = time.perf_counter()
+        with tqdm(total=len(img_list)) as pbar:
+            for processed in pool.imap(run_shard, shards):
+                pbar.update(processed)
+        elapsed = time.perf_counter() - start
+    print(
+        "=> {} workers: {:.3f}s, {:.2f} images/s".format(
+            workers, elapsed, len(img_list) / elapsed
+        )
+    )
+    return elapsed
+
+
+def report_scaling(img_list):
+    """ Run the folder with an increasing number of workers, and report
+    throughput, speedup and efficiency with respect to a single worker """
+    counts = [1]
+    while counts[-1] * 2 < opts.workers:
+        counts.append(counts[-1] * 2)
+    if opts.workers > 1:
+        counts.append(opts.workers)
+    results = [(workers, run_workers(img_list, workers)) for workers in counts]
+
+    print("=> scaling report, {} images".format(len(img_list)))
+    header = ("workers", "images/s", "speedup", "efficiency")
+    print("{:<10}{:>12}{:>10}{:>12}".format(*header))
+    reference = results[0][1]
+    for workers, elapsed in results:
+        speedup = reference / elapsed
+        print(
+            "{:<10}{:>12.2f}{:>10.2f}{:>11.1f}%".format(
+                workers, len(img_list) / elapsed, speedup, 100.0 * speedup / workers
+            )
+        )
+
+
+def main():
+    startup = StartupReport()
+    startup.mark("imports")
+    if opts.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    if opts.height < 1 or opts.width < 1:
+        raise ValueError("height and width must be greater than 0")
+    if opts.batch_size < 1:
+        raise ValueError("batch_size must be greater than 0")
+    if opts.num_workers < 1:
+        raise ValueError("num_workers must be greater than 0")
+    if opts.prefetch < 0:
+        raise ValueError("prefetch cannot be negative")
+    if opts.tile_batch_size < 1:
+        raise ValueError("tile_batch_size must be greater than 0")
+    if opts.tiled and opts.stream:
+        raise ValueError("tiled mode does not support streams")
+    if opts.in_graph_postprocessing:
+        if opts.backend != "tf":
+            raise ValueError("in-graph post-processing requires tf backend")
+        if opts.stream or opts.tiled:
+            raise ValueError("in-graph post-processing is only for images")
+    if opts.workers < 1:
+        raise ValueError("workers must be greater than 0")
+    if opts.workers > 1 or opts.scaling_report:
+        if opts.stream or opts.tiled or opts.in_graph_postprocessing:
+            raise ValueError("workers are only for folders, without other modes")
+    if opts.cpu_affinity and not hasattr(os, "sched_setaffinity"):
+        raise ValueError("cpu affinity is not supported on this platform")
+    trace_iterations = set(int(i) for i in opts.trace_iterations.split(",") if i)
+
+    if opts.stream:
+        img_list = None
+    elif os.path.isfile(opts.img):
         img_list = [opts.img]
     elif os.path.isdir(opts.img):
         img_list = glob.glob(os.path.join(opts.img, "*.{}".format("png")))
@@ -72,45 +683,94 @@ def main(_):
     else:
         raise Exception("No image nor folder provided")
 
-    model = network.Pydnet(network_params)
-    tensor_image = tf.placeholder(tf.float32, shape=(320, 640, 3))
-    batch_img = tf.expand_dims(tensor_image, 0)
-    tensor_depth = model.forward(batch_img)
-    tensor_depth = tf.nn.relu(tensor_depth)
+    if opts.workers > 1 or opts.scaling_report:
+        # NOTE: models are loaded by the workers only
+        create_dir(opts.dest)
+        if opts.scaling_report:
+            report_scaling(img_list)
+        else:
+            run_workers(img_list, opts.workers)
+        return
 
-    # restore graph
-    saver = tf.train.Saver()
-    sess = tf.Session()
-    sess.run(tf.global_variables_initializer())
-    saver.restore(sess, opts.ckpt)
+    if opts.backend not in ["tflite", "onnx"]:
+        import_tensorflow()
+        startup.mark("tensorflow import")
+
+    predictor = load_predictor(opts.num_threads, opts.inter_op_threads)
+    if isinstance(predictor, PredictorCache):
+        # NOTE: graphs are built lazily, the one of the network input is
+        # built and restored here, so that it is part of model loading
+        predictor.get(padded_size(opts.height), padded_size(opts.width))
+    startup.mark("model loading")
+
+    create_dir(opts.dest)
+    if opts.stream:
+        run_stream(predictor, startup)
+        return
+
+    num_batches = (len(img_list) + opts.batch_size - 1) // opts.batch_size
+    if opts.in_graph_postprocessing and trace_iterations:
+        print("WARNING: in-graph post-processing cannot be traced")
+        trace_iterations = set()
+    if trace_iterations and not hasattr(predictor, "trace"):
+        print("WARNING: {} backend cannot be traced".format(opts.backend))
+        trace_iterations = set()
+    start = time.perf_counter()
+    if opts.tiled:
+        run_tiled(predictor, img_list)
+        report_profile(start, len(img_list))
+        return
 
     # run graph
-    for i in tqdm(range(len(img_list))):
-
-        # preparing image
-        img = cv2.imread(img_list[i])
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        h, w, _ = img.shape
-        img = cv2.resize(img, (640, 320))
-        img = img / 255.0
-
-        # inference
-        depth = sess.run(tensor_depth, feed_dict={tensor_image: img})
-        depth = np.squeeze(depth)
-        min_depth = depth.min()
-        max_depth = depth.max()
-        depth = (depth - min_depth) / (max_depth - min_depth)
-        depth *= 255.0
-
-        # preparing final depth
-        if opts.original_size:
-            depth = cv2.resize(depth, (w, h))
-        name = os.path.basename(img_list[i]).split(".")[0]
-        dest = opts.dest
-        create_dir(dest)
-        dest = os.path.join(dest, name + "_depth.png")
-        plt.imsave(dest, depth, cmap="magma")
+    # NOTE: images are decoded and results are written by background threads,
+    # so that the session does not wait for disk or image codecs.
+    # The last batch may be shorter than batch_size, the batch
+    # dimension of the placeholder is dynamic so it is handled as is
+    with ThreadPoolExecutor(opts.num_workers) as reader, ThreadPoolExecutor(
+        opts.num_workers
+    ) as writer:
+        pending_writes = collections.deque()
+        shape = (predictor.height, predictor.width)
+        batches = prefetch_batches(
+            img_list, opts.batch_size, reader, opts.prefetch, shape
+        )
+        batches = tqdm(batches, total=num_batches)
+        for i, (batch_list, batch_img, batch_shapes) in enumerate(batches):
+            keys = [os.path.basename(p) for p in batch_list]
+
+            # inference
+            with timer.measure(keys, "inference"):
+                if opts.in_graph_postprocessing:
+                    batch_depth = predict_encoded(predictor, batch_img, batch_shapes)
+                elif i in trace_iterations:
+                    trace_path = os.path.join(opts.dest, "trace_{}.json".format(i))
+                    batch_depth = predictor.trace(batch_img, trace_path)
+                else:
+                    batch_depth = predictor.predict(batch_img)
+
+            for key, depth, shape in zip(keys, batch_depth, batch_shapes):
+                dest = output_path(key)
+                if opts.in_graph_postprocessing:
+                    write = writer.submit(save_encoded, depth, dest, key)
+                else:
+                    write = writer.submit(save_depth, depth, shape, dest, key)
+                pending_writes.append(write)
+
+            if opts.report_startup and startup is not None:
+                report_first_batch(startup, pending_writes)
+                startup = None
+
+            # NOTE: bound the number of results waiting to be written
+            while len(pending_writes) > opts.prefetch * opts.batch_size:
+                pending_writes.popleft().result()
+
+        for write in pending_writes:
+            write.result()
+
+    report_profile(start, len(img_list))
 
 
 if __name__ == "__main__":
-    tf.app.run()
+    opts = parser.parse_args()
+    timer = StageTimer(enabled=opts.profile)
+    main()
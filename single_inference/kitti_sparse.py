@@ -0,0 +1,111 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sparse ground truth of the Eigen split of KITTI.
+LiDAR ground truth has only a few percent of valid pixels, so only their
+coordinates and depths are stored, concatenated over the images in npy
+arrays, and the pixels of each image are read lazily from memory maps.
+
+Usage:
+    python kitti_sparse.py --gt_path gt_depths.npz --dest gt_sparse
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from eval_utils import SparseDepth
+
+INDEX_FILE = "index.json"
+ARRAYS = ["rows", "cols", "depths"]
+
+
+def exists(sparse_dir):
+    """ True if sparse_dir contains converted ground truth """
+    return os.path.exists(os.path.join(sparse_dir, INDEX_FILE))
+
+
+def convert(gt_path, sparse_dir):
+    """ Convert gt_depths.npz, made by export_gt_depth.py of monodepth2
+    Args:
+        gt_path: path to gt_depths.npz
+        sparse_dir: destination folder
+    """
+    gt_depths = np.load(gt_path, fix_imports=True, encoding="latin1", allow_pickle=True)[
+        "data"
+    ]
+    shapes = []
+    offsets = [0]
+    values = {name: [] for name in ARRAYS}
+    for gt_depth in tqdm(gt_depths):
+        sparse_depth = SparseDepth.from_dense(gt_depth)
+        shapes.append(sparse_depth.shape)
+        offsets.append(offsets[-1] + len(sparse_depth.depths))
+        # NOTE: kitti images are smaller than 65536 pixels on each side
+        values["rows"].append(sparse_depth.rows.astype(np.uint16))
+        values["cols"].append(sparse_depth.cols.astype(np.uint16))
+        values["depths"].append(sparse_depth.depths)
+
+    os.makedirs(sparse_dir, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(sparse_dir, name + ".npy"), np.concatenate(values[name]))
+
+    # NOTE: the index is written last, so an interrupted conversion is not used
+    index = {"shapes": [list(shape) for shape in shapes], "offsets": offsets}
+    with open(os.path.join(sparse_dir, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+
+
+class SparseGroundTruth:
+    """ Ground truth converted by convert, read one image at a time """
+
+    def __init__(self, sparse_dir):
+        if not exists(sparse_dir):
+            raise ValueError(f"Cannot find sparse ground truth in {sparse_dir}")
+        with open(os.path.join(sparse_dir, INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.shapes = index["shapes"]
+        self.offsets = index["offsets"]
+        self.arrays = {
+            name: np.load(os.path.join(sparse_dir, name + ".npy"), mmap_mode="r")
+            for name in ARRAYS
+        }
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, index):
+        pixels = slice(self.offsets[index], self.offsets[index + 1])
+        return SparseDepth(
+            self.shapes[index],
+            self.arrays["rows"][pixels],
+            self.arrays["cols"][pixels],
+            self.arrays["depths"][pixels],
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert KITTI ground truth to sparse")
+    parser.add_argument("--gt_path", type=str, help="path to gt_depths.npz", required=True)
+    parser.add_argument("--dest", type=str, help="sparse ground truth folder", default="gt_sparse")
+    opts = parser.parse_args()
+    convert(opts.gt_path, opts.dest)
+    print(f"=> saved sparse ground truth to {opts.dest}")
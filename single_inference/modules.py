@@ -32,6 +32,16 @@ def leaky_relu(x, alpha=0.2):
     return tf.nn.leaky_relu(x, alpha=alpha)
 
 
+def cast_like(x, reference):
+    """ Cast x to the type of reference, e.g. float32 variables to the
+    type of float16 features. Checkpoints always store float32 variables
+    """
+    dtype = reference.dtype.base_dtype
+    if x.dtype.base_dtype == dtype:
+        return x
+    return tf.cast(x, dtype)
+
+
 ####################################################################################################################################
 # 2D convolution wrapper
 ####################################################################################################################################
@@ -51,6 +61,8 @@ def conv2d_leaky(
         initializer=tf.truncated_normal_initializer(),
         dtype=tf.float32,
     )
+    weights = cast_like(weights, input)
+    biases = cast_like(biases, input)
     output = tf.nn.conv2d(
         input,
         weights,
@@ -142,7 +154,101 @@ def bilinear_upsampling_by_convolution(src):
         width = shape[2] * 2
         channels = shape[3]
         upsampled_src = tf.image.resize_images(src, [height, width])
+        # NOTE: bilinear resize always returns float32
+        upsampled_src = cast_like(upsampled_src, src)
         upsampled_src = conv2d_leaky(
             upsampled_src, [2, 2, channels, channels], [channels]
         )
         return upsampled_src
+
+
+####################################################################################################################################
+# Fused bilinear upsampling and convolution, for inference
+####################################################################################################################################
+# NOTE: after a 2x bilinear upsampling (tf.image.resize_images, without
+# aligned corners), output row 2i + p of a 2x2 convolution is a combination
+# of input rows i and i + 1. UPSAMPLING_COEFFICIENTS[p][t][d] is the weight of
+# kernel row d in the combination applied to input row i + t. Columns are
+# handled the same way.
+UPSAMPLING_COEFFICIENTS = np.array(
+    [[[1.0, 0.5], [0.0, 0.5]], [[0.5, 0.0], [0.5, 1.0]]], dtype=np.float32
+)
+
+
+def fuse_upsampling_kernel(weights):
+    """ Convert the [2, 2, C_in, C_out] kernel of a convolution applied after a
+    2x bilinear upsampling into a [2, 2, C_in, 4 * C_out] kernel applied at low
+    resolution, whose output channels are the four phases of depth_to_space
+    """
+    shape = weights.get_shape().as_list()
+    in_channels, out_channels = shape[2], shape[3]
+    coefficients = np.einsum(
+        "pta,qub->tupqab", UPSAMPLING_COEFFICIENTS, UPSAMPLING_COEFFICIENTS
+    ).reshape(16, 4)
+    kernel = tf.matmul(
+        tf.constant(coefficients, dtype=weights.dtype.base_dtype),
+        tf.reshape(weights, [4, -1]),
+    )
+    kernel = tf.reshape(kernel, [2, 2, 2, 2, in_channels, out_channels])
+    kernel = tf.transpose(kernel, [0, 1, 4, 2, 3, 5])
+    return tf.reshape(kernel, [2, 2, in_channels, 4 * out_channels])
+
+
+def upsample_and_convolve(src, weights):
+    """ 2x bilinear upsampling followed by a 2x2 convolution, without bias """
+    shape = src.get_shape().as_list()
+    upsampled_src = tf.image.resize_images(src, [shape[1] * 2, shape[2] * 2])
+    upsampled_src = cast_like(upsampled_src, src)
+    return tf.nn.conv2d(upsampled_src, weights, strides=[1, 1, 1, 1], padding="SAME")
+
+
+def fused_bilinear_upsampling_by_convolution(src):
+    """ Inference form of bilinear_upsampling_by_convolution.
+    The convolution runs at low resolution with a kernel derived from the
+    original weights, followed by depth_to_space, so that the upsampled
+    features are never materialized. Variables are the same of
+    bilinear_upsampling_by_convolution, so checkpoints are loaded as they are
+    """
+    with tf.variable_scope("bilinear_upsampling_by_convolution"):
+        shape = src.get_shape().as_list()
+        height = shape[1]
+        width = shape[2]
+        channels = shape[3]
+        weights = tf.get_variable(
+            "weights",
+            [2, 2, channels, channels],
+            initializer=tf.contrib.layers.xavier_initializer(),
+            dtype=tf.float32,
+        )
+        biases = tf.get_variable(
+            "biases",
+            [channels],
+            initializer=tf.truncated_normal_initializer(),
+            dtype=tf.float32,
+        )
+
+        # NOTE: the kernel is derived from float32 weights, then cast
+        kernel = cast_like(fuse_upsampling_kernel(weights), src)
+        weights = cast_like(weights, src)
+        biases = cast_like(biases, src)
+
+        # NOTE: bilinear upsampling replicates the last row and column
+        padded_src = tf.pad(src, [[0, 0], [0, 1], [0, 1], [0, 0]], mode="SYMMETRIC")
+        output = tf.nn.conv2d(
+            padded_src,
+            kernel,
+            strides=[1, 1, 1, 1],
+            padding="VALID",
+        )
+        output = tf.nn.depth_to_space(output, 2)
+
+        # NOTE: instead, the original convolution pads with zeros the last
+        # row and column of the upsampled features, so they are computed in
+        # the original form over the last input row and column only
+        last_row = upsample_and_convolve(src[:, height - 1 :], weights)[:, 1:]
+        last_column = upsample_and_convolve(src[:, :, width - 1 :], weights)[:, :, 1:]
+        output = tf.concat([output[:, :-1, :-1], last_column[:, :-1]], 2)
+        output = tf.concat([output, last_row], 1)
+
+        output = tf.nn.bias_add(output, biases)
+        return leaky_relu(output, 0.2)
@@ -23,7 +23,35 @@
 
 # adapted from https://github.com/mattpoggi/pydnet/blob/master/pydnet.py
 import tensorflow as tf
-from modules import conv2d_leaky, bilinear_upsampling_by_convolution
+from modules import (
+    conv2d_leaky,
+    bilinear_upsampling_by_convolution,
+    fused_bilinear_upsampling_by_convolution,
+)
+
+# NOTE: output channels of conv1a, conv1b, ..., conv6a, conv6b
+ENCODER_CHANNELS = [16, 16, 32, 32, 64, 64, 96, 96, 128, 128, 192, 192]
+# NOTE: output channels of disp-3, disp-4 and disp-5 of each estimator
+ESTIMATOR_CHANNELS = [96, 64, 32]
+ESTIMATOR_OUTPUT_CHANNELS = 8
+
+
+def channel_widths(width_multiplier=1.0):
+    """ Channels of the layers of Pydnet, scaled by width_multiplier.
+    Returns:
+        dictionary with the output channels of the encoder convolutions
+        ("encoder") and of the estimators, from level 1 to 6 ("estimator")
+    """
+    if width_multiplier <= 0:
+        raise ValueError("width_multiplier must be greater than 0")
+
+    def scale(channels):
+        return max(int(round(channels * width_multiplier)), 1)
+
+    return {
+        "encoder": [scale(c) for c in ENCODER_CHANNELS],
+        "estimator": [[scale(c) for c in ESTIMATOR_CHANNELS] for _ in range(6)],
+    }
 
 
 class Pydnet(object):
@@ -32,17 +60,56 @@ class Pydnet(object):
         self.height = params["height"]
         self.width = params["width"]
         self.is_training = params["is_training"]
+        # NOTE: finest level of the decoder, from 1 (full network) to 6
+        self.exit_level = params.get("exit_level", 1)
+        # NOTE: fold upsampling and convolution of the decoder, same weights
+        self.fused_upsampling = params.get("fused_upsampling", False)
+        # NOTE: compute precision. Variables stay float32, as in checkpoints,
+        # and they are cast to float16 inside the graph
+        self.precision = tf.as_dtype(params.get("precision", "float32"))
+        # NOTE: channels of each layer, e.g. of a pruned checkpoint. Otherwise,
+        # the original ones scaled by width_multiplier
+        self.channels = params.get("channels") or channel_widths(
+            params.get("width_multiplier", 1.0)
+        )
         self.output_nodes = None
 
+        if len(self.channels["encoder"]) != len(ENCODER_CHANNELS):
+            raise ValueError(
+                "encoder channels must be {}".format(len(ENCODER_CHANNELS))
+            )
+        if len(self.channels["estimator"]) != 6 or any(
+            len(c) != len(ESTIMATOR_CHANNELS) for c in self.channels["estimator"]
+        ):
+            raise ValueError(
+                "estimator channels must be {} for each level".format(
+                    len(ESTIMATOR_CHANNELS)
+                )
+            )
+
+        if self.precision not in [tf.float32, tf.float16]:
+            raise ValueError("precision must be float32 or float16")
+
+        if self.exit_level not in range(1, 7):
+            raise ValueError("exit_level must be in [1, 6]")
         if self.is_training:
             self.scales = params["scales"]
+            if self.exit_level != 1:
+                raise ValueError("exit_level is supported only at inference time")
+            if self.fused_upsampling:
+                raise ValueError("fused_upsampling is supported only at inference time")
+            if self.precision != tf.float32:
+                raise ValueError("float16 is supported only at inference time")
 
     def forward(self, input_image):
         """ Single forward of the network
         """
+        if self.precision != tf.float32:
+            input_image = tf.cast(input_image, self.precision)
         encoder_features = self.encoder(input_image)
         predictions = self.decoder(encoder_features)
         if not self.is_training:
+            predictions = tf.cast(predictions, tf.float32)
             # NOTE: set up nodes for mobile app
             self.output_nodes = [self.make_visual(predictions)]
         return predictions
@@ -57,106 +124,65 @@ class Pydnet(object):
     def encoder(self, input_image):
         """ Create PyDNet feature extractor
         """
+        channels = self.channels["encoder"]
         with tf.variable_scope("encoder"):
             features = []
             features.append(input_image)
-            with tf.variable_scope("conv1a"):
-                conv1a = conv2d_leaky(input_image, [3, 3, 3, 16], [16], 2, True)
-            with tf.variable_scope("conv1b"):
-                conv1b = conv2d_leaky(conv1a, [3, 3, 16, 16], [16], 1, True)
-
-            features.append(conv1b)
-
-            with tf.variable_scope("conv2a"):
-                conv2a = conv2d_leaky(conv1b, [3, 3, 16, 32], [32], 2, True)
-            with tf.variable_scope("conv2b"):
-                conv2b = conv2d_leaky(conv2a, [3, 3, 32, 32], [32], 1, True)
-
-            features.append(conv2b)
-
-            with tf.variable_scope("conv3a"):
-                conv3a = conv2d_leaky(conv2b, [3, 3, 32, 64], [64], 2, True)
-            with tf.variable_scope("conv3b"):
-                conv3b = conv2d_leaky(conv3a, [3, 3, 64, 64], [64], 1, True)
-
-            features.append(conv3b)
-
-            with tf.variable_scope("conv4a"):
-                conv4a = conv2d_leaky(conv3b, [3, 3, 64, 96], [96], 2, True)
-            with tf.variable_scope("conv4b"):
-                conv4b = conv2d_leaky(conv4a, [3, 3, 96, 96], [96], 1, True)
-
-            features.append(conv4b)
-
-            with tf.variable_scope("conv5a"):
-                conv5a = conv2d_leaky(conv4b, [3, 3, 96, 128], [128], 2, True)
-            with tf.variable_scope("conv5b"):
-                conv5b = conv2d_leaky(conv5a, [3, 3, 128, 128], [128], 1, True)
-
-            features.append(conv5b)
-
-            with tf.variable_scope("conv6a"):
-                conv6a = conv2d_leaky(conv5b, [3, 3, 128, 192], [192], 2, True)
-            with tf.variable_scope("conv6b"):
-                conv6b = conv2d_leaky(conv6a, [3, 3, 192, 192], [192], 1, True)
-
-            features.append(conv6b)
+            conv = input_image
+            for level in range(1, 7):
+                # NOTE: a stride-2 convolution followed by a stride-1 one
+                channels_a = channels[2 * level - 2]
+                channels_b = channels[2 * level - 1]
+                with tf.variable_scope("conv{}a".format(level)):
+                    conv = conv2d_leaky(
+                        conv, [3, 3, conv.shape[3], channels_a], [channels_a], 2, True
+                    )
+                with tf.variable_scope("conv{}b".format(level)):
+                    conv = conv2d_leaky(
+                        conv, [3, 3, channels_a, channels_b], [channels_b], 1, True
+                    )
+
+                features.append(conv)
             return features
 
     def decoder(self, encoder_features):
-        """ Create PyDNet decoder
+        """ Create PyDNet decoder.
+        At inference time, the decoder stops at exit_level, so that finer
+        levels are not built
         """
+        if self.fused_upsampling:
+            upsampling = fused_bilinear_upsampling_by_convolution
+        else:
+            upsampling = bilinear_upsampling_by_convolution
+
         with tf.variable_scope("decoder"):
-            with tf.variable_scope("L6") as scope:
-                with tf.variable_scope("estimator") as scope:
-                    conv6 = self.build_estimator(encoder_features[6])
-                    prediction_6 = self.get_disp(conv6)
-                with tf.variable_scope("upsampler") as scope:
-                    upconv6 = bilinear_upsampling_by_convolution(conv6)
-            # SCALE 5
-            with tf.variable_scope("L5") as scope:
-                with tf.variable_scope("estimator") as scope:
-                    conv5 = self.build_estimator(encoder_features[5], upconv6)
-                    prediction_5 = self.get_disp(conv5)
-                with tf.variable_scope("upsampler") as scope:
-                    upconv5 = bilinear_upsampling_by_convolution(conv5)
-            # SCALE 4
-            with tf.variable_scope("L4") as scope:
-                with tf.variable_scope("estimator") as scope:
-                    conv4 = self.build_estimator(encoder_features[4], upconv5)
-                    prediction_4 = self.get_disp(conv4)
-                with tf.variable_scope("upsampler") as scope:
-                    upconv4 = bilinear_upsampling_by_convolution(conv4)
-            # SCALE 3
-            with tf.variable_scope("L3") as scope:
-                with tf.variable_scope("estimator") as scope:
-                    conv3 = self.build_estimator(encoder_features[3], upconv4)
-                    prediction_3 = self.get_disp(conv3)
-                with tf.variable_scope("upsampler") as scope:
-                    upconv3 = bilinear_upsampling_by_convolution(conv3)
-            # SCALE 2
-            with tf.variable_scope("L2") as scope:
-                with tf.variable_scope("estimator") as scope:
-                    conv2 = self.build_estimator(encoder_features[2], upconv3)
-                    prediction_2 = self.get_disp(conv2)
-                with tf.variable_scope("upsampler") as scope:
-                    upconv2 = bilinear_upsampling_by_convolution(conv2)
-            # SCALE 1
-            with tf.variable_scope("L1") as scope:
-                with tf.variable_scope("estimator") as scope:
-                    conv1 = self.build_estimator(encoder_features[1], upconv2)
-                    prediction_1 = self.get_disp(conv1)
+            predictions = {}
+            upconv = None
+            for level in range(6, self.exit_level - 1, -1):
+                with tf.variable_scope("L{}".format(level)) as scope:
+                    with tf.variable_scope("estimator") as scope:
+                        conv = self.build_estimator(
+                            encoder_features[level],
+                            upconv,
+                            self.channels["estimator"][level - 1],
+                        )
+                        predictions[level] = self.get_disp(conv)
+                    if level > self.exit_level:
+                        with tf.variable_scope("upsampler") as scope:
+                            upconv = upsampling(conv)
 
             size = [self.height, self.width]
 
             if not self.is_training:
                 with tf.variable_scope("half"):
-                    prediction_1 = tf.image.resize_images(prediction_1, size)
-                return prediction_1
+                    prediction = tf.image.resize_images(
+                        predictions[self.exit_level], size
+                    )
+                return prediction
 
-            prediction_1 = tf.image.resize_images(prediction_1, size)
-            prediction_2 = tf.image.resize_images(prediction_2, size)
-            prediction_3 = tf.image.resize_images(prediction_3, size)
+            prediction_1 = tf.image.resize_images(predictions[1], size)
+            prediction_2 = tf.image.resize_images(predictions[2], size)
+            prediction_3 = tf.image.resize_images(predictions[3], size)
 
             return [prediction_1, prediction_2, prediction_3]
 
@@ -168,23 +194,36 @@ class Pydnet(object):
             return disp
 
     # Single scale estimator
-    def build_estimator(self, features, upsampled_disp=None):
+    def build_estimator(self, features, upsampled_disp=None, channels=None):
         """
             Create single scale estimator
+            channels: output channels of disp-3, disp-4 and disp-5
         """
+        if channels is None:
+            channels = ESTIMATOR_CHANNELS
         with tf.variable_scope("build_estimator"):
             if upsampled_disp is not None:
                 disp2 = tf.concat([features, upsampled_disp], -1)
             else:
                 disp2 = features
             with tf.variable_scope("disp-3") as scope:
-                disp3 = conv2d_leaky(disp2, [3, 3, disp2.shape[3], 96], [96], 1, True)
+                disp3 = conv2d_leaky(
+                    disp2, [3, 3, disp2.shape[3], channels[0]], [channels[0]], 1, True
+                )
             with tf.variable_scope("disp-4") as scope:
-                disp4 = conv2d_leaky(disp3, [3, 3, disp3.shape[3], 64], [64], 1, True)
+                disp4 = conv2d_leaky(
+                    disp3, [3, 3, disp3.shape[3], channels[1]], [channels[1]], 1, True
+                )
             with tf.variable_scope("disp-5") as scope:
-                disp5 = conv2d_leaky(disp4, [3, 3, disp4.shape[3], 32], [32], 1, True)
+                disp5 = conv2d_leaky(
+                    disp4, [3, 3, disp4.shape[3], channels[2]], [channels[2]], 1, True
+                )
             with tf.variable_scope("disp-6") as scope:
                 disp6 = conv2d_leaky(
-                    disp5, [3, 3, disp5.shape[3], 8], [8], 1, True
+                    disp5,
+                    [3, 3, disp5.shape[3], ESTIMATOR_OUTPUT_CHANNELS],
+                    [ESTIMATOR_OUTPUT_CHANNELS],
+                    1,
+                    True,
                 )  # 8 channels for compatibility with @other@ devices
             return disp6
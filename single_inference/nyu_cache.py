@@ -0,0 +1,114 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cache of the NYU v2 test split.
+Images and raw depths of the test split are converted once from the mat
+files into contiguous npy arrays, already in HxW(x3) layout, and read back as
+memory maps, so that evaluations do not parse the mat files again.
+
+Usage:
+    python nyu_cache.py --labels nyu_depth_v2_labeled.mat --splits splits.mat \
+        --dest nyu_cache
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+INDEX_FILE = "index.json"
+IMAGES_FILE = "images.npy"
+DEPTHS_FILE = "depths.npy"
+
+
+def exists(cache_dir):
+    """ True if cache_dir contains a converted test split """
+    return os.path.exists(os.path.join(cache_dir, INDEX_FILE))
+
+
+def convert(labels, splits, cache_dir):
+    """ Convert the test split of NYU v2
+    Args:
+        labels: path to nyu_depth_v2_labeled.mat
+        splits: path to splits.mat
+        cache_dir: destination folder
+    """
+    import h5py
+    from scipy.io import loadmat
+
+    indices = [int(ind[0]) - 1 for ind in loadmat(splits)["testNdxs"]]
+    os.makedirs(cache_dir, exist_ok=True)
+    with h5py.File(labels, "r") as f:
+        images = f["images"]
+        raw_depths = f["rawDepths"]
+        # NOTE: mat files are column major, images are 3xWxH
+        _, width, height = images.shape[1:]
+        images_cache = np.lib.format.open_memmap(
+            os.path.join(cache_dir, IMAGES_FILE),
+            mode="w+",
+            dtype=images.dtype,
+            shape=(len(indices), height, width, 3),
+        )
+        depths_cache = np.lib.format.open_memmap(
+            os.path.join(cache_dir, DEPTHS_FILE),
+            mode="w+",
+            dtype=raw_depths.dtype,
+            shape=(len(indices), height, width),
+        )
+        for i, ind in enumerate(tqdm(indices)):
+            images_cache[i] = np.swapaxes(images[ind], 0, 2)
+            depths_cache[i] = np.swapaxes(raw_depths[ind], 0, 1)
+        images_cache.flush()
+        depths_cache.flush()
+    del images_cache, depths_cache
+
+    # NOTE: the index is written last, so an interrupted conversion is not used
+    index = {"indices": indices, "images": IMAGES_FILE, "depths": DEPTHS_FILE}
+    with open(os.path.join(cache_dir, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+
+
+class NYUCache:
+    """ Test split of NYU v2, read from a cache made by convert """
+
+    def __init__(self, cache_dir):
+        if not exists(cache_dir):
+            raise ValueError(f"Cannot find a NYU cache in {cache_dir}")
+        with open(os.path.join(cache_dir, INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.indices = index["indices"]
+        self.images = np.load(os.path.join(cache_dir, index["images"]), mmap_mode="r")
+        self.depths = np.load(os.path.join(cache_dir, index["depths"]), mmap_mode="r")
+
+    def __call__(self):
+        for img in self.images:
+            yield img
+
+    def read_gt_files(self):
+        """Names and raw depths of the test split, as NYUGenerator"""
+        return [str(ind) for ind in self.indices], self.depths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the NYU v2 test split")
+    parser.add_argument(
+        "--labels", type=str, help="path to dataset", default="nyu_depth_v2_labeled.mat"
+    )
+    parser.add_argument("--splits", type=str, help="path to splits", default="splits.mat")
+    parser.add_argument("--dest", type=str, help="cache folder", default="nyu_cache")
+    opts = parser.parse_args()
+    convert(opts.labels, opts.splits, opts.dest)
+    print(f"=> saved NYU test split to {opts.dest}")
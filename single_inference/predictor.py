@@ -0,0 +1,610 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load Pydnet once and run it over batches of images.
+Backends:
+    tf: graph built from network.Pydnet and restored from a checkpoint
+    frozen: graph and weights packed in a single protobuf by freeze.py
+    tflite: model exported by export.py, run by the tflite interpreter
+    onnx: model exported by export.py, run by onnxruntime on cpu
+NOTE: tensorflow is imported only when a backend needs it, since its import
+is a large part of the startup time
+"""
+import collections
+import json
+
+import cv2
+import numpy as np
+
+
+def prepare_frame(img, height=320, width=640):
+    """ Prepare a BGR image for the network
+    Args:
+        img: BGR image
+        height: height of the network input
+        width: width of the network input
+    Returns:
+        the normalized RGB image and its original (height, width)
+    """
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    h, w, _ = img.shape
+    img = cv2.resize(img, (width, height))
+    img = img.astype(np.float32) / 255.0
+    return img, (h, w)
+
+
+BACKENDS = ["tf", "frozen", "tflite", "onnx"]
+
+# NOTE: names of onnxruntime.GraphOptimizationLevel values
+ONNX_OPTIMIZATIONS = collections.OrderedDict(
+    [
+        ("disable", "ORT_DISABLE_ALL"),
+        ("basic", "ORT_ENABLE_BASIC"),
+        ("extended", "ORT_ENABLE_EXTENDED"),
+        ("all", "ORT_ENABLE_ALL"),
+    ]
+)
+
+INPUT_NODE = "im0"
+OUTPUT_NODE = "depth"
+
+# NOTE: the encoder of Pydnet has six stride-2 convolutions
+STRIDE = 64
+
+
+def import_tensorflow():
+    """ Import tensorflow, silencing its logs """
+    import tensorflow as tf
+
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+    return tf
+
+
+def padded_size(size, stride=STRIDE):
+    """ Smallest multiple of stride not lower than size """
+    return (size + stride - 1) // stride * stride
+
+
+def load_network_config(path):
+    """ Load additional params of network.Pydnet from a json file, e.g. the
+    channels of a checkpoint pruned by prune.py. If path is None, no params
+    are loaded
+    """
+    if path is None:
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def build_graph(height, width, network_options=None):
+    """ Build Pydnet for inference, in the default graph
+    Args:
+        height: height of the network input
+        width: width of the network input
+        network_options: additional params of network.Pydnet, e.g. exit_level
+    Returns:
+        input placeholder, with dynamic batch size, and predicted depth
+    """
+    tf = import_tensorflow()
+    import network
+
+    network_params = {"height": height, "width": width, "is_training": False}
+    network_params.update(network_options or {})
+    model = network.Pydnet(network_params)
+    tensor_image = tf.placeholder(
+        tf.float32, shape=(None, height, width, 3), name=INPUT_NODE
+    )
+    tensor_depth = model.forward(tensor_image)
+    tensor_depth = tf.nn.relu(tensor_depth, name=OUTPUT_NODE)
+    return tensor_image, tensor_depth
+
+
+def build_postprocessing(tensor_depth, output_format):
+    """ Post-processing of the predicted depth inside the graph, so that the
+    session returns images ready to be encoded: crop, resize, min/max
+    normalization of each sample and quantization as colormap.encode_depth
+    Args:
+        tensor_depth: NxHxWx1 predicted depth, after relu
+        output_format: one of colormap.OUTPUT_FORMATS
+    Returns:
+        crop placeholder, the (height, width) of the valid region of the
+        depth, size placeholder, the (height, width) of the outputs, and NxHxW
+        images (NxHxWx3 for color). By default, depth is neither cropped nor
+        resized
+    """
+    tf = import_tensorflow()
+    from colormap import MAGMA_BGR, OUTPUT_FORMATS
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format {}".format(output_format))
+    with tf.name_scope("postprocessing"):
+        _, height, width, _ = tensor_depth.shape.as_list()
+        tensor_crop = tf.placeholder_with_default(
+            tf.constant([height, width]), shape=[2], name="crop"
+        )
+        tensor_size = tf.placeholder_with_default(tensor_crop, shape=[2], name="size")
+        depth = tensor_depth[:, : tensor_crop[0], : tensor_crop[1]]
+        # NOTE: half pixel centers, as cv2.resize
+        depth = tf.compat.v1.image.resize_bilinear(
+            depth, tensor_size, half_pixel_centers=True
+        )
+        min_depth = tf.reduce_min(depth, axis=[1, 2, 3], keepdims=True)
+        max_depth = tf.reduce_max(depth, axis=[1, 2, 3], keepdims=True)
+        # NOTE: constant depth is normalized to zeros
+        depth = tf.math.divide_no_nan(depth - min_depth, max_depth - min_depth)
+        depth = depth[..., 0]
+        if output_format == "color":
+            indices = tf.cast(tf.minimum(depth * 256.0, 255.0), tf.int32)
+            image = tf.gather(tf.constant(MAGMA_BGR), indices)
+        elif output_format == "uint8":
+            image = tf.cast(tf.round(depth * 255.0), tf.uint8)
+        else:
+            image = tf.cast(tf.round(depth * 65535.0), tf.uint16)
+    return tensor_crop, tensor_size, image
+
+
+def freeze(ckpt, dest, height=320, width=640, network_options=None):
+    """ Pack graph and weights of a checkpoint into a single protobuf
+    Args:
+        ckpt: path to checkpoint
+        dest: path of the frozen graph
+        height: height of the network input
+        width: width of the network input
+        network_options: additional params of network.Pydnet
+    """
+    if height % STRIDE != 0 or width % STRIDE != 0:
+        raise ValueError("height and width must be multiple of {}".format(STRIDE))
+    tf = import_tensorflow()
+    from tensorflow.python.framework import graph_util
+
+    with tf.Graph().as_default() as graph:
+        build_graph(height, width, network_options)
+        saver = tf.train.Saver()
+        with tf.Session(graph=graph) as sess:
+            saver.restore(sess, ckpt)
+            graph_def = graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), [OUTPUT_NODE]
+            )
+    graph_def = graph_util.remove_training_nodes(graph_def)
+    with tf.io.gfile.GFile(dest, "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+
+def session_config(num_threads=None, inter_op_threads=None):
+    """ Session configuration with the given number of intra-op and
+    inter-op threads. None or 0 lets tensorflow choose """
+    if not num_threads and not inter_op_threads:
+        return None
+    tf = import_tensorflow()
+    return tf.ConfigProto(
+        intra_op_parallelism_threads=num_threads or 0,
+        inter_op_parallelism_threads=inter_op_threads or 0,
+    )
+
+
+class Predictor(object):
+    """ Pydnet restored from a checkpoint, in its own graph and session.
+    If ckpt is None, weights are randomly initialized (e.g. for benchmarks).
+    If output_format is set, the graph also post-processes the depth (see
+    build_postprocessing and predict_encoded)
+    """
+
+    def __init__(
+        self,
+        ckpt,
+        height=320,
+        width=640,
+        num_threads=None,
+        config=None,
+        network_options=None,
+        output_format=None,
+    ):
+        tf = import_tensorflow()
+        self.height = height
+        self.width = width
+        if config is None:
+            config = session_config(num_threads)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.tensor_image, self.tensor_depth = build_graph(
+                height, width, network_options
+            )
+            if output_format is not None:
+                (
+                    self.tensor_crop,
+                    self.tensor_size,
+                    self.tensor_encoded,
+                ) = build_postprocessing(self.tensor_depth, output_format)
+
+            # restore graph
+            # NOTE: all the variables are restored, so running their
+            # initializers first is not needed
+            self.sess = tf.Session(graph=self.graph, config=config)
+            if ckpt is None:
+                self.sess.run(tf.global_variables_initializer())
+            else:
+                saver = tf.train.Saver()
+                saver.restore(self.sess, ckpt)
+
+    def predict(self, batch_img):
+        """ Run the network
+        Args:
+            batch_img: NxHxWx3 batch of normalized RGB images
+        Returns:
+            NxHxW predicted depths
+        """
+        batch_depth = self.sess.run(
+            self.tensor_depth, feed_dict={self.tensor_image: batch_img}
+        )
+        return batch_depth[..., 0]
+
+    def predict_encoded(self, batch_img, size=None, crop=None):
+        """ Run the network and the post-processing of the graph
+        Args:
+            batch_img: NxHxWx3 batch of normalized RGB images
+            size: (height, width) of the outputs, by default the crop size
+            crop: (height, width) of the valid region of the inputs, by
+                default the whole input
+        Returns:
+            images as colormap.encode_depth
+        """
+        feed_dict = {self.tensor_image: batch_img}
+        if crop is not None:
+            feed_dict[self.tensor_crop] = crop
+        if size is not None:
+            feed_dict[self.tensor_size] = size
+        return self.sess.run(self.tensor_encoded, feed_dict=feed_dict)
+
+    def trace(self, batch_img, path):
+        """ Run the network collecting the step stats of tensorflow, and save
+        them as chrome trace (open it in chrome://tracing)
+        Args:
+            batch_img: NxHxWx3 batch of normalized RGB images
+            path: path of the trace
+        Returns:
+            NxHxW predicted depths
+        """
+        tf = import_tensorflow()
+        from tensorflow.python.client import timeline
+
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        batch_depth = self.sess.run(
+            self.tensor_depth,
+            feed_dict={self.tensor_image: batch_img},
+            options=run_options,
+            run_metadata=run_metadata,
+        )
+        trace = timeline.Timeline(run_metadata.step_stats)
+        with open(path, "w") as f:
+            f.write(trace.generate_chrome_trace_format())
+        return batch_depth[..., 0]
+
+    def close(self):
+        self.sess.close()
+
+
+class PredictorCache(object):
+    """ Pydnet at any input resolution.
+    Inputs are padded to a multiple of the network stride, and predictions
+    are cropped back. A Predictor is built for each padded shape, and the
+    least recently used one is released when more than cache_size are alive
+    """
+
+    def __init__(
+        self,
+        ckpt,
+        height=320,
+        width=640,
+        num_threads=None,
+        cache_size=4,
+        network_options=None,
+        output_format=None,
+        inter_op_threads=None,
+    ):
+        if cache_size < 1:
+            raise ValueError("cache_size must be greater than 0")
+        self.ckpt = ckpt
+        self.network_options = network_options
+        self.output_format = output_format
+        self.height = height
+        self.width = width
+        self.num_threads = num_threads
+        self.inter_op_threads = inter_op_threads
+        self.cache_size = cache_size
+        self.predictors = collections.OrderedDict()
+
+    def get(self, height, width):
+        """ Get the predictor of a padded shape, building it if required """
+        key = (height, width)
+        if key in self.predictors:
+            self.predictors.move_to_end(key)
+            return self.predictors[key]
+        predictor = Predictor(
+            self.ckpt,
+            height,
+            width,
+            config=session_config(self.num_threads, self.inter_op_threads),
+            network_options=self.network_options,
+            output_format=self.output_format,
+        )
+        self.predictors[key] = predictor
+        if len(self.predictors) > self.cache_size:
+            _, oldest = self.predictors.popitem(last=False)
+            oldest.close()
+        return predictor
+
+    def pad(self, batch_img):
+        """ Pad a batch to a multiple of the network stride
+        Returns:
+            the predictor of the padded shape, the padded batch and the
+            original (height, width)
+        """
+        _, h, w, _ = batch_img.shape
+        padded_h, padded_w = padded_size(h), padded_size(w)
+        if (padded_h, padded_w) != (h, w):
+            padding = ((0, 0), (0, padded_h - h), (0, padded_w - w), (0, 0))
+            batch_img = np.pad(batch_img, padding, mode="edge")
+        return self.get(padded_h, padded_w), batch_img, (h, w)
+
+    def predict(self, batch_img, trace_path=None):
+        """ Run the network
+        Args:
+            batch_img: NxHxWx3 batch of normalized RGB images, of any size
+            trace_path: if set, save a chrome trace of this run (see
+                Predictor.trace)
+        Returns:
+            NxHxW predicted depths
+        """
+        predictor, batch_img, (h, w) = self.pad(batch_img)
+        if trace_path is None:
+            batch_depth = predictor.predict(batch_img)
+        else:
+            batch_depth = predictor.trace(batch_img, trace_path)
+        return batch_depth[:, :h, :w]
+
+    def predict_encoded(self, batch_img, size=None):
+        """ Run the network and the post-processing of the graph
+        Args:
+            batch_img: NxHxWx3 batch of normalized RGB images, of any size
+            size: (height, width) of the outputs, by default the input size
+        Returns:
+            images as colormap.encode_depth
+        """
+        predictor, batch_img, (h, w) = self.pad(batch_img)
+        return predictor.predict_encoded(batch_img, size=size, crop=(h, w))
+
+    def trace(self, batch_img, path):
+        return self.predict(batch_img, trace_path=path)
+
+    def close(self):
+        for predictor in self.predictors.values():
+            predictor.close()
+        self.predictors.clear()
+
+
+class FrozenPredictor(Predictor):
+    """ Pydnet loaded from a protobuf written by freeze.
+    NOTE: the resolution is the one chosen when freezing
+    """
+
+    def __init__(self, frozen_path, num_threads=None, config=None):
+        tf = import_tensorflow()
+        if config is None:
+            config = session_config(num_threads)
+        graph_def = tf.GraphDef()
+        with tf.io.gfile.GFile(frozen_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.tensor_image = self.graph.get_tensor_by_name(INPUT_NODE + ":0")
+        self.tensor_depth = self.graph.get_tensor_by_name(OUTPUT_NODE + ":0")
+        _, self.height, self.width, _ = self.tensor_image.shape.as_list()
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+
+def tflite_interpreter():
+    """ Interpreter class of the lightweight tflite runtime, if installed,
+    otherwise the one of tensorflow """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        Interpreter = import_tensorflow().lite.Interpreter
+    return Interpreter
+
+
+class TFLitePredictor(object):
+    """ Pydnet exported as tflite model by export.py.
+    NOTE: the exported model has a fixed input of a single image, and it
+    returns the depth normalized by Pydnet.make_visual
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        Interpreter = tflite_interpreter()
+        try:
+            self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        except TypeError:
+            # NOTE: older interpreters do not accept num_threads
+            print("WARNING: num_threads not supported by this tflite interpreter")
+            self.interpreter = Interpreter(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        _, self.height, self.width, _ = input_details["shape"]
+
+        # NOTE: views over the buffers allocated by the interpreter, so
+        # that inputs and outputs are not reallocated at each run
+        self.input_tensor = self.interpreter.tensor(input_details["index"])
+        self.output_tensor = self.interpreter.tensor(output_details["index"])
+
+        # NOTE: fully quantized models may have integer inputs and outputs
+        self.input_dtype = input_details["dtype"]
+        self.input_quantization = input_details["quantization"]
+        self.output_quantization = output_details["quantization"]
+        self.quantized_output = output_details["dtype"] != np.float32
+
+    def quantize_input(self, img):
+        if self.input_dtype == np.float32:
+            return img
+        scale, zero_point = self.input_quantization
+        info = np.iinfo(self.input_dtype)
+        img = np.round(img / scale + zero_point)
+        return np.clip(img, info.min, info.max).astype(self.input_dtype)
+
+    def predict(self, batch_img):
+        """ Run the network
+        Args:
+            batch_img: NxHxWx3 batch of normalized RGB images
+        Returns:
+            NxHxW predicted depths
+        """
+        batch_depth = np.empty(batch_img.shape[:3], dtype=np.float32)
+        for i, img in enumerate(batch_img):
+            self.input_tensor()[0] = self.quantize_input(img)
+            self.interpreter.invoke()
+            batch_depth[i] = self.output_tensor()[0, :, :, 0]
+        if self.quantized_output:
+            scale, zero_point = self.output_quantization
+            batch_depth = (batch_depth - zero_point) * scale
+        return batch_depth
+
+    def close(self):
+        pass
+
+
+class ONNXPredictor(object):
+    """ Pydnet exported as onnx model by export.py, run by onnxruntime.
+    NOTE: as the tflite model, it returns the depth normalized by
+    Pydnet.make_visual. Models with a fixed batch size of one are run once
+    for each image
+    """
+
+    def __init__(
+        self, model_path, num_threads=None, inter_op_threads=None, optimization="all"
+    ):
+        import onnxruntime
+
+        if optimization not in ONNX_OPTIMIZATIONS:
+            raise ValueError("Unknown onnx optimization {}".format(optimization))
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = getattr(
+            onnxruntime.GraphOptimizationLevel, ONNX_OPTIMIZATIONS[optimization]
+        )
+        self.session = onnxruntime.InferenceSession(model_path, options)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.output_name = self.session.get_outputs()[0].name
+        batch_size, self.height, self.width, _ = model_input.shape
+        self.single_image = batch_size == 1
+
+    def predict(self, batch_img):
+        """ Run the network
+        Args:
+            batch_img: NxHxWx3 batch of normalized RGB images
+        Returns:
+            NxHxW predicted depths
+        """
+        batch_img = batch_img.astype(np.float32, copy=False)
+        if not self.single_image:
+            batch_depth = self.session.run(
+                [self.output_name], {self.input_name: batch_img}
+            )[0]
+            return batch_depth[..., 0]
+        batch_depth = np.empty(batch_img.shape[:3], dtype=np.float32)
+        for i in range(len(batch_img)):
+            batch_depth[i] = self.session.run(
+                [self.output_name], {self.input_name: batch_img[i : i + 1]}
+            )[0][0, :, :, 0]
+        return batch_depth
+
+    def close(self):
+        pass
+
+
+def create_predictor(
+    backend,
+    ckpt=None,
+    tflite=None,
+    num_threads=None,
+    height=320,
+    width=640,
+    cache_size=4,
+    frozen=None,
+    network_options=None,
+    onnx=None,
+    onnx_optimization="all",
+    output_format=None,
+    inter_op_threads=None,
+):
+    """ Create the predictor of the selected backend
+    Args:
+        backend: one of BACKENDS
+        ckpt: path to checkpoint, for tf backend
+        tflite: path to tflite model, for tflite backend
+        num_threads: number of threads used by the backend
+        height: default input height, for tf backend. Tflite models have the
+            resolution chosen at export time
+        width: default input width, for tf backend
+        cache_size: number of input shapes kept in memory, for tf backend
+        frozen: path to frozen graph, for frozen backend
+        network_options: additional params of network.Pydnet, for tf backend.
+            Frozen, tflite and onnx models are built with the options chosen
+            at export time
+        onnx: path to onnx model, for onnx backend
+        onnx_optimization: graph optimization level of onnxruntime, one of
+            ONNX_OPTIMIZATIONS
+        output_format: if set, post-process the depth in the graph, for tf
+            backend (see PredictorCache.predict_encoded)
+        inter_op_threads: number of inter-op threads, for tf, frozen and onnx
+            backends
+    """
+    if backend == "tf":
+        if ckpt is None:
+            raise ValueError("tf backend requires a checkpoint")
+        return PredictorCache(
+            ckpt,
+            height,
+            width,
+            num_threads,
+            cache_size,
+            network_options,
+            output_format,
+            inter_op_threads,
+        )
+    if backend == "frozen":
+        if frozen is None:
+            raise ValueError("frozen backend requires a frozen graph")
+        return FrozenPredictor(
+            frozen, config=session_config(num_threads, inter_op_threads)
+        )
+    if backend == "tflite":
+        if tflite is None:
+            raise ValueError("tflite backend requires a tflite model")
+        return TFLitePredictor(tflite, num_threads=num_threads)
+    if backend == "onnx":
+        if onnx is None:
+            raise ValueError("onnx backend requires an onnx model")
+        return ONNXPredictor(
+            onnx,
+            num_threads=num_threads,
+            inter_op_threads=inter_op_threads,
+            optimization=onnx_optimization,
+        )
+    raise ValueError("Unknown backend {}".format(backend))
@@ -0,0 +1,128 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lightweight per-stage timing of the inference loop.
+"""
+import collections
+import csv
+import json
+import threading
+import time
+
+import numpy as np
+
+
+class _NullMeasure(object):
+    """ Context manager that does nothing, used when timing is disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_MEASURE = _NullMeasure()
+
+
+class _Measure(object):
+    def __init__(self, timer, keys, stage):
+        self.timer = timer
+        self.keys = keys
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        # NOTE: time of batched stages is split among their images
+        for key in self.keys:
+            self.timer.add(key, self.stage, elapsed / len(self.keys))
+        return False
+
+
+class StageTimer(object):
+    """ Wall time of each stage, for each image.
+    Stages may be measured by different threads. When disabled, measure
+    returns a shared no-op context manager, so the overhead is negligible
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self.times = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def measure(self, keys, stage):
+        """ Context manager measuring a stage
+        Args:
+            keys: image, or list of images of a batch
+            stage: name of the stage
+        """
+        if not self.enabled:
+            return NULL_MEASURE
+        if not isinstance(keys, (list, tuple)):
+            keys = [keys]
+        return _Measure(self, keys, stage)
+
+    def add(self, key, stage, elapsed):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages.append(stage)
+            times = self.times.setdefault(key, {})
+            times[stage] = times.get(stage, 0.0) + elapsed
+
+    def table(self):
+        """ Times of each image, as a list of rows with a column per stage """
+        rows = []
+        for key, times in self.times.items():
+            row = {"image": key}
+            row.update({stage: times.get(stage, 0.0) for stage in self.stages})
+            row["total"] = sum(times.values())
+            rows.append(row)
+        return rows
+
+    def summary(self):
+        """ Print mean, p95 and share of the total time of each stage """
+        rows = self.table()
+        if not rows:
+            return
+        totals = np.array([row["total"] for row in rows])
+        print("=> timing of {} images".format(len(rows)))
+        print("{:<16}{:>12}{:>12}{:>10}".format("stage", "mean (ms)", "p95 (ms)", "share"))
+        for stage in self.stages + ["total"]:
+            values = np.array([row[stage] for row in rows])
+            print(
+                "{:<16}{:>12.3f}{:>12.3f}{:>9.1f}%".format(
+                    stage,
+                    values.mean() * 1000.0,
+                    np.percentile(values, 95) * 1000.0,
+                    100.0 * values.sum() / totals.sum(),
+                )
+            )
+
+    def dump(self, path):
+        """ Save the times of each image as csv or json, by extension """
+        rows = self.table()
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump(rows, f, indent=2)
+            return
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["image"] + self.stages + ["total"])
+            writer.writeheader()
+            writer.writerows(rows)
@@ -0,0 +1,296 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Prune the filters of a checkpoint, without retraining.
+Filters of each convolution are ranked by L1 norm and the weakest ones are
+removed, together with the matching input channels of the following layers.
+The slimmer checkpoint is saved with a network config, loaded by the
+scripts with --network_config. The outputs of the estimators (8 channels)
+are kept as they are.
+
+Usage:
+    python prune.py --ckpt ckpt/pydnet --dest pruned --keep_ratio 0.75 \
+        --data_path kitti --gt_path gt_depths.npz
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from network import ESTIMATOR_OUTPUT_CHANNELS
+from predictor import (
+    STRIDE,
+    Predictor,
+    build_graph,
+    import_tensorflow,
+    load_network_config,
+)
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+
+ENCODER_LAYERS = [
+    "conv{}{}".format(level, conv) for level in range(1, 7) for conv in "ab"
+]
+ESTIMATOR_LAYERS = ["disp-3", "disp-4", "disp-5"]
+
+
+def estimator_scope(level, layer):
+    """ Scope of a convolution of the estimator at a level """
+    return "decoder/L{}/estimator/build_estimator/{}".format(level, layer)
+
+
+def select_filters(weights, keep_ratio, min_channels):
+    """ Indices of the filters with highest L1 norm, in their original order
+    Args:
+        weights: HxWxCINxCOUT weights of a convolution
+        keep_ratio: fraction of filters to keep
+        min_channels: filters to keep at least
+    """
+    channels = weights.shape[-1]
+    keep = min(max(int(round(channels * keep_ratio)), min_channels), channels)
+    l1_norm = np.abs(weights).sum(axis=(0, 1, 2))
+    ranking = np.argsort(-l1_norm, kind="stable")
+    return np.sort(ranking[:keep])
+
+
+def prune_layer(variables, scope, inputs, outputs):
+    """ Keep the given input channels and output filters of a convolution """
+    weights = variables[scope + "/weights"]
+    variables[scope + "/weights"] = weights[:, :, inputs][..., outputs]
+    variables[scope + "/biases"] = variables[scope + "/biases"][outputs]
+
+
+def prune(variables, keep_ratio, min_channels=8):
+    """ Prune the filters of Pydnet
+    Args:
+        variables: dictionary from variable name to value
+        keep_ratio: fraction of filters to keep in each convolution
+        min_channels: filters to keep at least in each convolution
+    Returns:
+        pruned variables, and channels of each layer (see network.channel_widths)
+    """
+    variables = dict(variables)
+    channels = {"encoder": [], "estimator": []}
+    features = {}
+    inputs = np.arange(3)
+    for index, layer in enumerate(ENCODER_LAYERS):
+        scope = "encoder/" + layer
+        weights = variables[scope + "/weights"]
+        outputs = select_filters(weights, keep_ratio, min_channels)
+        prune_layer(variables, scope, inputs, outputs)
+        channels["encoder"].append(len(outputs))
+        if layer.endswith("b"):
+            features[index // 2 + 1] = (outputs, weights.shape[-1])
+        inputs = outputs
+
+    for level in range(1, 7):
+        outputs, feature_channels = features[level]
+        inputs = outputs
+        if level < 6:
+            # NOTE: upsampled outputs of the coarser level follow the features
+            upsampled = feature_channels + np.arange(ESTIMATOR_OUTPUT_CHANNELS)
+            inputs = np.concatenate([outputs, upsampled])
+        level_channels = []
+        for layer in ESTIMATOR_LAYERS:
+            scope = estimator_scope(level, layer)
+            outputs = select_filters(
+                variables[scope + "/weights"], keep_ratio, min_channels
+            )
+            prune_layer(variables, scope, inputs, outputs)
+            level_channels.append(len(outputs))
+            inputs = outputs
+        prune_layer(
+            variables,
+            estimator_scope(level, "disp-6"),
+            inputs,
+            np.arange(ESTIMATOR_OUTPUT_CHANNELS),
+        )
+        channels["estimator"].append(level_channels)
+    return variables, channels
+
+
+def load_variables(ckpt):
+    """ Load the variables of a checkpoint as numpy arrays """
+    tf = import_tensorflow()
+    reader = tf.train.load_checkpoint(ckpt)
+    return {
+        name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()
+    }
+
+
+def save_checkpoint(variables, network_config, ckpt):
+    """ Save the variables of Pydnet built from network_config
+    NOTE: variables not used by Pydnet at inference, e.g. optimizer slots,
+    are dropped
+    """
+    tf = import_tensorflow()
+    with tf.Graph().as_default() as graph:
+        build_graph(STRIDE, STRIDE, network_config)
+        with tf.Session(graph=graph) as sess:
+            for variable in tf.global_variables():
+                variable.load(variables[variable.op.name], sess)
+            tf.train.Saver().save(sess, ckpt)
+
+
+def count_params(network_config):
+    """ Number of parameters of Pydnet built from network_config """
+    tf = import_tensorflow()
+    with tf.Graph().as_default():
+        build_graph(STRIDE, STRIDE, network_config)
+        return sum(int(np.prod(v.shape.as_list())) for v in tf.global_variables())
+
+
+def measure_latency(ckpt, network_config, height, width, iterations):
+    """ Mean latency of a single image, in seconds """
+    predictor = Predictor(ckpt, height, width, network_options=network_config)
+    batch_img = np.random.uniform(size=(1, height, width, 3)).astype(np.float32)
+    predictor.predict(batch_img)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        predictor.predict(batch_img)
+    latency = (time.perf_counter() - start) / iterations
+    predictor.close()
+    return latency
+
+
+def evaluate_kitti(ckpt, network_config_path, opts):
+    """ abs_rel of a checkpoint on the KITTI test split, see test_kitti.py """
+    tf = import_tensorflow()
+    import test_kitti
+    from evaluation import evaluate
+
+    kitti_opts = argparse.Namespace(
+        ckpt=ckpt,
+        data_path=opts.data_path,
+        gt_path=opts.gt_path,
+        sparse_gt=None,
+        data_list_file=opts.data_list_file,
+        dest=None,
+        save_predictions=False,
+        max_depth=80.0,
+        height=opts.height,
+        width=opts.width,
+        precision="float32",
+        network_config=network_config_path,
+        in_graph_postprocessing=False,
+        metrics_batch_size=4,
+        eval_workers=0,
+    )
+    with tf.Graph().as_default():
+        return evaluate(test_kitti.create_loader(kitti_opts), kitti_opts)["abs_rel"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune filters of a checkpoint")
+    parser.add_argument("--ckpt", type=str, help="path to checkpoint", required=True)
+    parser.add_argument(
+        "--network_config",
+        type=str,
+        help="json with network params of the checkpoint, if already pruned",
+    )
+    parser.add_argument(
+        "--dest", type=str, help="folder of pruned checkpoint and config", required=True
+    )
+    parser.add_argument(
+        "--keep_ratio",
+        type=float,
+        help="fraction of filters to keep in each convolution",
+        default=0.75,
+    )
+    parser.add_argument(
+        "--min_channels",
+        type=int,
+        help="filters to keep at least in each convolution",
+        default=8,
+    )
+    parser.add_argument("--height", type=int, help="height of the network input", default=320)
+    parser.add_argument("--width", type=int, help="width of the network input", default=640)
+    parser.add_argument(
+        "--iterations", type=int, help="runs to measure latency", default=20
+    )
+    parser.add_argument(
+        "--data_path", type=str, help="path to kitti, to report abs_rel"
+    )
+    parser.add_argument("--gt_path", type=str, help="path to gt_depths.npz")
+    parser.add_argument(
+        "--data_list_file", type=str, help="path to data list", default="test_kitti.txt"
+    )
+    opts = parser.parse_args()
+
+    if not 0 < opts.keep_ratio <= 1:
+        raise ValueError("keep_ratio must be in (0, 1]")
+    if opts.height % STRIDE != 0 or opts.width % STRIDE != 0:
+        raise ValueError("height and width must be multiple of {}".format(STRIDE))
+
+    os.makedirs(opts.dest, exist_ok=True)
+    network_config = load_network_config(opts.network_config)
+    variables = load_variables(opts.ckpt)
+    pruned_variables, channels = prune(variables, opts.keep_ratio, opts.min_channels)
+
+    pruned_ckpt = os.path.join(opts.dest, "pydnet")
+    pruned_network_config = dict(network_config)
+    pruned_network_config["channels"] = channels
+    pruned_network_config_path = os.path.join(opts.dest, "network_config.json")
+    save_checkpoint(pruned_variables, pruned_network_config, pruned_ckpt)
+    with open(pruned_network_config_path, "w") as f:
+        json.dump(pruned_network_config, f, indent=2)
+    print("=> saved {} and {}".format(pruned_ckpt, pruned_network_config_path))
+    print("=> encoder channels: {}".format(channels["encoder"]))
+
+    report = {
+        "original": {
+            "params": count_params(network_config),
+            "latency": measure_latency(
+                opts.ckpt, network_config, opts.height, opts.width, opts.iterations
+            ),
+        },
+        "pruned": {
+            "params": count_params(pruned_network_config),
+            "latency": measure_latency(
+                pruned_ckpt,
+                pruned_network_config,
+                opts.height,
+                opts.width,
+                opts.iterations,
+            ),
+        },
+    }
+    if opts.data_path is not None and opts.gt_path is not None:
+        report["original"]["abs_rel"] = evaluate_kitti(
+            opts.ckpt, opts.network_config, opts
+        )
+        report["pruned"]["abs_rel"] = evaluate_kitti(
+            pruned_ckpt, pruned_network_config_path, opts
+        )
+
+    print("=> pruning report")
+    print("{:<10}{:>12}{:>14}{:>10}".format("model", "params", "latency (ms)", "abs_rel"))
+    for name, result in report.items():
+        abs_rel = result.get("abs_rel")
+        print(
+            "{:<10}{:>12}{:>14.2f}{:>10}".format(
+                name,
+                result["params"],
+                result["latency"] * 1000.0,
+                "-" if abs_rel is None else "{:.4f}".format(abs_rel),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Long-lived depth estimation server.
+The checkpoint is restored once, and concurrent requests are grouped into
+batches of at most max_batch_size images, waiting at most max_wait_ms for
+a batch to fill up. Requests may ask for one of the input resolutions given
+to the server, whose graphs are all built at startup.
+
+Usage:
+    python server.py --ckpt ckpt/pydnet --port 8080 --resolutions 192x384,320x640
+    curl --data-binary @test/0.png "localhost:8080/depth?format=color" -o depth.png
+"""
+import argparse
+import collections
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from colormap import OUTPUT_FORMATS, encode_depth
+from predictor import PredictorCache, padded_size, prepare_frame
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+
+def parse_resolutions(values):
+    """ Parse a comma separated list of resolutions as HEIGHTxWIDTH """
+    resolutions = []
+    for value in values.split(","):
+        if value:
+            height, width = value.lower().split("x")
+            resolutions.append((int(height), int(width)))
+    return resolutions
+
+
+class MicroBatcher(object):
+    """ Group concurrent requests into batches for the predictor """
+
+    def __init__(self, predictor, max_batch_size=8, max_wait_ms=5.0, max_queue_size=64):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue(max_queue_size)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, img):
+        """ Enqueue an image prepared for the network
+        Args:
+            img: HxWx3 normalized RGB image
+        Returns:
+            a Future of the predicted depth
+        Raises:
+            queue.Full if too many requests are waiting
+        """
+        future = Future()
+        self.requests.put_nowait((img, future))
+        return future
+
+    def next_batch(self):
+        """ Wait for a request, then collect the others until the batch is
+        full or max_wait is elapsed """
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while self.running:
+            batch = self.next_batch()
+
+            # NOTE: requests at different resolutions are run separately
+            groups = collections.OrderedDict()
+            for img, future in batch:
+                groups.setdefault(img.shape, []).append((img, future))
+            for group in groups.values():
+                self.run_group(group)
+
+    def run_group(self, group):
+        # NOTE: requests cancelled by their handlers, e.g. after a timeout,
+        # are not run
+        group = [
+            (img, future) for img, future in group if future.set_running_or_notify_cancel()
+        ]
+        if not group:
+            return
+        try:
+            batch_depth = self.predictor.predict(np.stack([img for img, _ in group], 0))
+        except Exception as e:
+            for _, future in group:
+                future.set_exception(e)
+            return
+        for (_, future), depth in zip(group, batch_depth):
+            future.set_result(depth)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+
+class DepthRequestHandler(BaseHTTPRequestHandler):
+    """ POST /depth with an encoded image as body. Query parameters:
+        format: one of OUTPUT_FORMATS, default color
+        original_size: if 1, restore the size of the input image
+        height, width: resolution of the network input, one of the resolutions
+            of the server, default set by the server
+    Returns a png image. GET /health reports the number of queued requests.
+    """
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self.send_error(404)
+            return
+        body = "queued: {}\n".format(self.server.batcher.requests.qsize()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/depth":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        output_format = query.get("format", ["color"])[0]
+        original_size = query.get("original_size", ["0"])[0] == "1"
+        if output_format not in OUTPUT_FORMATS:
+            self.send_error(400, "Unknown format {}".format(output_format))
+            return
+        try:
+            height = int(query.get("height", [self.server.height])[0])
+            width = int(query.get("width", [self.server.width])[0])
+        except ValueError:
+            self.send_error(400, "Invalid resolution")
+            return
+        # NOTE: only resolutions whose graphs are built at startup, so that
+        # requests never rebuild graphs on the batcher thread
+        if (height, width) not in self.server.resolutions:
+            supported = ",".join("{}x{}".format(h, w) for h, w in self.server.resolutions)
+            self.send_error(400, "Unsupported resolution, use one of {}".format(supported))
+            return
+
+        # NOTE: the body is read only if its size is known and bounded
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0:
+            self.send_error(400, "Missing or invalid Content-Length")
+            return
+        if length > self.server.max_body_bytes:
+            self.send_error(413, "Image larger than {} MB".format(self.server.max_body_mb))
+            return
+        data = np.frombuffer(self.rfile.read(length), dtype=np.uint8)
+        img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if img is None:
+            self.send_error(400, "Cannot decode image")
+            return
+        img, (h, w) = prepare_frame(img, height, width)
+
+        try:
+            future = self.server.batcher.submit(img)
+        except queue.Full:
+            # NOTE: backpressure, clients should retry later
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        try:
+            depth = future.result(timeout=self.server.timeout_s)
+        except Exception as e:
+            # NOTE: a timed out request is dropped, if it is still queued
+            future.cancel()
+            self.send_error(500, str(e))
+            return
+
+        if original_size:
+            depth = cv2.resize(depth, (w, h))
+        _, body = cv2.imencode(".png", encode_depth(depth, output_format))
+        body = body.tobytes()
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def address_string(self):
+        # NOTE: unix sockets do not have a client address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Depth estimation server")
+    parser.add_argument("--ckpt", type=str, help="path to checkpoint", required=True)
+    parser.add_argument("--cpu", action="store_true", help="run on cpu")
+    parser.add_argument("--host", type=str, help="address to bind", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="port to bind", default=8080)
+    parser.add_argument(
+        "--socket", type=str, help="if set, listen on this unix socket instead of tcp"
+    )
+    parser.add_argument(
+        "--height", type=int, help="default height of the network input", default=320
+    )
+    parser.add_argument(
+        "--width", type=int, help="default width of the network input", default=640
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=str,
+        help="comma separated resolutions accepted from requests, e.g. 192x384,320x640, "
+        "in addition to the default one",
+        default="",
+    )
+    parser.add_argument(
+        "--max_batch_size", type=int, help="maximum number of images per run", default=8
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        help="maximum time spent waiting for a batch to fill up",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--max_queue_size",
+        type=int,
+        help="maximum number of waiting requests, others are rejected with 503",
+        default=64,
+    )
+    parser.add_argument(
+        "--timeout", type=float, help="seconds before a request fails", default=30.0
+    )
+    parser.add_argument(
+        "--max_body_mb",
+        type=float,
+        help="maximum size of a request image, larger ones are rejected with 413",
+        default=16.0,
+    )
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    opts = parser.parse_args()
+
+    if opts.cpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+    if opts.max_batch_size < 1:
+        raise ValueError("max_batch_size must be greater than 0")
+    if opts.max_queue_size < 1:
+        raise ValueError("max_queue_size must be greater than 0")
+    if opts.max_body_mb <= 0:
+        raise ValueError("max_body_mb must be greater than 0")
+
+    resolutions = [(opts.height, opts.width)]
+    for resolution in parse_resolutions(opts.resolutions):
+        if resolution not in resolutions:
+            resolutions.append(resolution)
+    if any(height < 1 or width < 1 for height, width in resolutions):
+        raise ValueError("resolutions must be greater than 0")
+
+    # NOTE: a graph for each padded shape, built before serving requests
+    padded_shapes = sorted(set((padded_size(h), padded_size(w)) for h, w in resolutions))
+    predictor = PredictorCache(
+        opts.ckpt, opts.height, opts.width, cache_size=len(padded_shapes)
+    )
+    for padded_height, padded_width in padded_shapes:
+        predictor.get(padded_height, padded_width)
+    print("=> built graphs of {} resolutions".format(len(resolutions)))
+    batcher = MicroBatcher(
+        predictor, opts.max_batch_size, opts.max_wait_ms, opts.max_queue_size
+    )
+
+    if opts.socket:
+        if os.path.exists(opts.socket):
+            os.remove(opts.socket)
+        server = UnixHTTPServer(opts.socket, DepthRequestHandler)
+        print("=> listening on {}".format(opts.socket))
+    else:
+        server = ThreadingHTTPServer((opts.host, opts.port), DepthRequestHandler)
+        print("=> listening on {}:{}".format(opts.host, opts.port))
+    server.batcher = batcher
+    server.resolutions = resolutions
+    server.height = opts.height
+    server.width = opts.width
+    server.timeout_s = opts.timeout
+    server.max_body_mb = opts.max_body_mb
+    server.max_body_bytes = int(opts.max_body_mb * 2 ** 20)
+    server.verbose = opts.verbose
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        predictor.close()
+
+
+if __name__ == "__main__":
+    main()
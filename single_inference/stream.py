@@ -0,0 +1,261 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Utilities to process streams of frames, e.g. videos or image sequences,
+with memory bounded by the size of the internal queues.
+"""
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from colormap import encode_depth, normalize, write_depth
+
+
+def read_frames(source):
+    """ Generate the frames of a video or of an image sequence
+    Args:
+        source: path to a video file or pattern of an image sequence,
+            e.g. frames/%06d.png
+    Returns:
+        a generator of BGR frames
+    """
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError("Cannot open stream {}".format(source))
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def get_fps(source, default=30.0):
+    """ Get the frame rate of a stream, if available
+    Args:
+        source: path to a video file or pattern of an image sequence
+        default: frame rate returned if the stream does not provide it
+    """
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps if fps > 0 else default
+
+
+def iterate_in_background(iterable, maxsize):
+    """ Consume an iterable in a background thread
+    Args:
+        iterable: iterable to consume
+        maxsize: maximum number of items buffered ahead
+    Returns:
+        a generator of the items of iterable
+    """
+    items = queue.Queue(max(maxsize, 1))
+    end = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        items.put(end)
+
+    # NOTE: daemon thread, so that a consumer stopped early does not
+    # keep the process alive
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            break
+        yield item
+    if errors:
+        raise errors[0]
+
+
+def batched(iterable, batch_size):
+    """ Group the items of an iterable in lists of batch_size elements.
+    The last list may be shorter
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class MotionGate(object):
+    """ Skip the network on frames almost identical to the last keyframe,
+    reusing its depth. Frames are compared with the keyframe by mean absolute
+    difference of downsampled grayscale images, and a keyframe is forced
+    every refresh_interval frames.
+    If audit_interval is positive, one skipped frame every audit_interval is
+    run anyway, to measure the error of the reused depth
+    """
+
+    def __init__(self, threshold, refresh_interval=30, audit_interval=0, size=(64, 32)):
+        if refresh_interval < 1:
+            raise ValueError("refresh_interval must be greater than 0")
+        if audit_interval < 0:
+            raise ValueError("audit_interval cannot be negative")
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self.audit_interval = audit_interval
+        self.size = size
+        self.keyframe = None
+        self.last_depth = None
+        self.since_keyframe = 0
+        self.frames = 0
+        self.skipped = 0
+        self.refreshes = 0
+        self.audit_errors = []
+
+    def thumbnail(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA)
+
+    def is_keyframe(self, img):
+        """ Whether the network has to run on a frame, in stream order """
+        self.frames += 1
+        thumbnail = self.thumbnail(img)
+        refresh = self.since_keyframe + 1 >= self.refresh_interval
+        if (
+            self.keyframe is None
+            or refresh
+            or np.abs(thumbnail - self.keyframe).mean() >= self.threshold
+        ):
+            if self.keyframe is not None and refresh:
+                self.refreshes += 1
+            self.keyframe = thumbnail
+            self.since_keyframe = 0
+            return True
+        self.since_keyframe += 1
+        self.skipped += 1
+        return False
+
+    def predict(self, predictor, batch_img):
+        """ Run the network on the keyframes of a batch, and reuse the depth
+        of the last keyframe for the other frames
+        Args:
+            predictor: predictor of any backend
+            batch_img: NxHxWx3 batch of consecutive normalized RGB frames
+        Returns:
+            NxHxW predicted depths
+        """
+        sources = []
+        keyframes = []
+        audited = []
+        for i, img in enumerate(batch_img):
+            if self.is_keyframe(img):
+                keyframes.append(i)
+            elif self.audit_interval and self.skipped % self.audit_interval == 0:
+                audited.append(i)
+            sources.append(keyframes[-1] if keyframes else None)
+
+        batch_depth = np.empty(batch_img.shape[:3], dtype=np.float32)
+        run = sorted(keyframes + audited)
+        if run:
+            batch_depth[run] = predictor.predict(batch_img[run])
+        for i, source in enumerate(sources):
+            if i in keyframes:
+                continue
+            depth = self.last_depth if source is None else batch_depth[source]
+            if i in audited:
+                error = np.abs(normalize(depth) - normalize(batch_depth[i])).mean()
+                self.audit_errors.append(float(error))
+            batch_depth[i] = depth
+        self.last_depth = batch_depth[-1]
+        return batch_depth
+
+    def summary(self):
+        """ Skip rate and error of the reused depth, as text """
+        lines = [
+            "=> motion gating: {} of {} frames skipped ({:.1f}%), {} refreshes".format(
+                self.skipped,
+                self.frames,
+                100.0 * self.skipped / max(self.frames, 1),
+                self.refreshes,
+            )
+        ]
+        if self.audit_errors:
+            lines.append(
+                "=> reused depth error over {} audited frames: mean {:.4f}, "
+                "max {:.4f} (normalized depth)".format(
+                    len(self.audit_errors),
+                    np.mean(self.audit_errors),
+                    np.max(self.audit_errors),
+                )
+            )
+        return "\n".join(lines)
+
+
+class VideoDepthWriter(object):
+    """ Write depth maps incrementally into a video """
+
+    def __init__(self, path, fps, output_format="color"):
+        if output_format == "uint16":
+            raise ValueError("uint16 depth cannot be saved as video")
+        self.path = path
+        self.fps = fps
+        self.output_format = output_format
+        self.writer = None
+
+    def write(self, depth):
+        frame = encode_depth(depth, self.output_format)
+        if self.writer is None:
+            # NOTE: the size of the video is known only at the first frame
+            h, w = frame.shape[:2]
+            self.writer = cv2.VideoWriter(
+                self.path,
+                cv2.VideoWriter_fourcc(*"mp4v"),
+                self.fps,
+                (w, h),
+                frame.ndim == 3,
+            )
+            if not self.writer.isOpened():
+                raise ValueError("Cannot write video {}".format(self.path))
+        self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+class FramesDepthWriter(object):
+    """ Write depth maps incrementally as a sequence of images """
+
+    def __init__(self, folder, output_format="color"):
+        self.folder = folder
+        self.output_format = output_format
+        self.index = 0
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def write(self, depth):
+        path = os.path.join(self.folder, "{:06d}_depth.png".format(self.index))
+        write_depth(path, depth, self.output_format)
+        self.index += 1
+
+    def close(self):
+        pass
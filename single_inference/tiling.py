@@ -0,0 +1,114 @@
+# Copyright 2020 Filippo Aleotti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tiled inference of images larger than the network input.
+The image is split into overlapping tiles of the network size, run in
+batches, so that memory of the network depends on the number of tiles in a
+batch and not on the size of the image. Since depth of each tile is known up
+to scale and shift, tiles are aligned to the prediction of the whole
+(downsized) image before being blended.
+"""
+import cv2
+import numpy as np
+
+from eval_utils import compute_scale_and_shift
+
+
+def tile_starts(size, tile, overlap):
+    """ Start of the tiles covering [0, size), the last one ends at size
+    Args:
+        size: length of the image
+        tile: length of a tile
+        overlap: minimum overlap between consecutive tiles
+    """
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def blending_weights(height, width, overlap):
+    """ Weights of a tile, decreasing linearly towards the borders over
+    overlap pixels, so that seams between tiles are smooth """
+
+    def ramp(size):
+        distance = np.minimum(np.arange(size), np.arange(size)[::-1]) + 1.0
+        return np.minimum(distance / max(overlap, 1), 1.0)
+
+    return np.outer(ramp(height), ramp(width)).astype(np.float32)
+
+
+def align(depth, reference):
+    """ Align depth to reference by least squares scale and shift.
+    If the alignment is degenerate, e.g. on a constant tile, the reference is
+    returned
+    """
+    mask = np.ones_like(depth)
+    scale, shift = compute_scale_and_shift(depth, reference, mask)
+    if scale <= 0:
+        return reference
+    return scale * depth + shift
+
+
+def predict_tiled(predictor, img, tile_batch_size=4, overlap=64):
+    """ Predict the depth of an image at its own resolution
+    Args:
+        predictor: predictor of any backend, its input size is the tile size
+        img: HxWx3 normalized RGB image, of any size
+        tile_batch_size: number of tiles run together
+        overlap: minimum overlap between tiles, in pixels
+    Returns:
+        HxW depth, with the scale and shift of the prediction of the whole image
+    """
+    tile_h, tile_w = predictor.height, predictor.width
+    if overlap >= min(tile_h, tile_w):
+        raise ValueError("overlap must be smaller than the tile size")
+    h, w, _ = img.shape
+
+    # NOTE: the whole image at the network size gives the global layout
+    reference = cv2.resize(img, (tile_w, tile_h), interpolation=cv2.INTER_AREA)
+    reference = predictor.predict(reference[np.newaxis])[0]
+    reference = cv2.resize(reference, (w, h))
+
+    # NOTE: images smaller than a tile are padded
+    padded_h, padded_w = max(h, tile_h), max(w, tile_w)
+    if (padded_h, padded_w) != (h, w):
+        padding = ((0, padded_h - h), (0, padded_w - w))
+        img = np.pad(img, padding + ((0, 0),), mode="edge")
+        reference = np.pad(reference, padding, mode="edge")
+
+    depth = np.zeros((padded_h, padded_w), dtype=np.float32)
+    weight_sum = np.zeros((padded_h, padded_w), dtype=np.float32)
+    weights = blending_weights(tile_h, tile_w, overlap)
+    tiles = [
+        (y, x)
+        for y in tile_starts(padded_h, tile_h, overlap)
+        for x in tile_starts(padded_w, tile_w, overlap)
+    ]
+    for start in range(0, len(tiles), tile_batch_size):
+        batch_tiles = tiles[start : start + tile_batch_size]
+        batch_img = np.stack(
+            [img[y : y + tile_h, x : x + tile_w] for y, x in batch_tiles], 0
+        )
+        batch_depth = predictor.predict(batch_img)
+        for (y, x), tile_depth in zip(batch_tiles, batch_depth):
+            window = (slice(y, y + tile_h), slice(x, x + tile_w))
+            tile_depth = align(tile_depth, reference[window])
+            depth[window] += weights * tile_depth
+            weight_sum[window] += weights
+    depth /= weight_sum
+    return depth[:h, :w]